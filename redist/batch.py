@@ -0,0 +1,136 @@
+#!/usr/bin/env python
+""" Vectorised scoring and tallying of many plans at once. Plans are given as
+a matrix of district assignments (plans x nodes), as held by a PlanStore, and
+per-district totals are computed for every plan with a single bincount per
+attribute rather than by looping over nodes in python """
+
+import numpy as np
+
+
+def node_arrays(compiled):
+    """ Accepts a CompiledGraph and returns a dict of its flat arrays of the
+    node attributes used for scoring and elections, with nodes in sorted
+    order to match the columns of a PlanStore """
+
+    return {attr: getattr(compiled, attr) for attr in ["pop", "vote_circ", "vote_sqre"]}
+
+
+def distr_totals(plans, values, num_distrs):
+    """ Sums a per-node value over the districts of every plan in a plans x
+    nodes matrix of district assignments (numbered from 1). Returns a plans x
+    districts matrix of totals """
+
+    num_plans = len(plans)
+
+    # Offset each plan's district ids so every (plan, district) pair gets its
+    # own bin, then sum the node values into those bins in one pass
+    bins = plans.astype(np.intp) + (num_distrs + 1) * np.arange(num_plans)[:, None]
+    weights = np.broadcast_to(values, plans.shape)
+    totals = np.bincount(
+        bins.ravel(), weights=weights.ravel(), minlength=num_plans * (num_distrs + 1)
+    )
+
+    return totals.reshape(num_plans, num_distrs + 1)[:, 1:].astype(np.int64)
+
+
+def batch_tally(plans, arrays, num_distrs=None):
+    """ Computes per-district population and vote totals for every plan in a
+    plans x nodes matrix of district assignments, along with the population
+    variance of each plan (as score.score_pop()) and the winner of each
+    district. Arrays holds the node attributes from node_arrays(). Returns a
+    dict of arrays """
+
+    plans = np.asarray(plans)
+    if num_distrs is None:
+        num_distrs = int(plans.max()) if plans.size else 0
+
+    pop = distr_totals(plans, arrays["pop"], num_distrs)
+    vote_circ = distr_totals(plans, arrays["vote_circ"], num_distrs)
+    vote_sqre = distr_totals(plans, arrays["vote_sqre"], num_distrs)
+
+    # Winner is coded 1 for circle, -1 for square and 0 for a tie
+    winner = np.sign(vote_circ - vote_sqre)
+
+    tally = {
+        "pop": pop,
+        "vote_circ": vote_circ,
+        "vote_sqre": vote_sqre,
+        "var": pop.var(axis=1),
+        "winner": winner,
+        "seats_circ": (winner == 1).sum(axis=1),
+        "seats_sqre": (winner == -1).sum(axis=1),
+    }
+
+    return tally
+
+
+def batch_contig(plans, compiled, block=10000):
+    """ Determines if every district of every plan in a plans x nodes matrix
+    of district assignments is contiguous, working from the CSR adjacency of
+    a CompiledGraph. Plans are checked block rows at a time (see
+    block_contig()). Returns a boolean array over the plans """
+
+    plans = np.asarray(plans)
+    num_plans, num_nodes = plans.shape
+
+    # Lay the CSR neighbour lists out as a max degree x nodes matrix, with
+    # the k-th neighbour of every node in row k. Nodes with fewer neighbours
+    # are padded with themselves, which passes on no smaller label
+    degree = compiled.degree
+    width = int(degree.max()) if num_nodes else 0
+    nbors = np.tile(np.arange(num_nodes), (width, 1))
+    slots = np.arange(width)[:, None] < degree
+    nbors.T[slots.T] = compiled.indices
+
+    # The working arrays are several times the size of the plans they check,
+    # for every neighbour row, so a whole store is checked a block at a time
+    # to keep them bounded
+    checks = [
+        block_contig(plans[k : k + block], nbors) for k in range(0, num_plans, block)
+    ]
+    if not checks:
+        return np.zeros(0, dtype=bool)
+
+    return np.concatenate(checks)
+
+
+def block_contig(plans, nbors):
+    """ Contiguity check behind batch_contig() for one block of plans, given
+    the padded neighbour matrix. Each node starts labelled with its own index
+    and takes the smallest label among its neighbours in the same district
+    until no label changes, which leaves one label per connected piece of a
+    district. A plan is contiguous if it has as many pieces as districts """
+
+    num_plans, num_nodes = plans.shape
+
+    # Which of the neighbours are in the same district in each plan
+    inside = np.stack([plans[:, row] == plans for row in nbors])
+
+    # Labels are kept in the smallest type that holds them, as the work is
+    # all in passing them along edges
+    dtype = np.min_scalar_type(num_nodes)
+    labels = np.tile(np.arange(num_nodes, dtype=dtype), (num_plans, 1))
+    none = dtype.type(num_nodes)
+
+    # Plans whose labels are still changing, with their own copies of the
+    # labels and neighbours inside districts. Plans drop out as they settle
+    active = np.arange(num_plans)
+    curr = labels
+    while len(active):
+        # Pass labels along the edges inside districts, then jump each label
+        # to its own label to shorten the chains of labels
+        update = curr
+        for row, same in zip(nbors, inside):
+            update = np.minimum(update, np.where(same, curr[:, row], none))
+        update = np.take_along_axis(update, update, axis=1)
+
+        changed = (update != curr).any(axis=1)
+        labels[active] = update
+        active = active[changed]
+        curr = update[changed]
+        inside = inside[:, changed]
+
+    pieces = (labels == np.arange(num_nodes)).sum(axis=1)
+    distrs = (np.diff(np.sort(plans, axis=1), axis=1) != 0).sum(axis=1) + 1
+
+    return pieces == distrs
@@ -1,114 +1,350 @@
 #!/usr/bin/env python
 
 # Imports
+import math
 import timeit
-import pandas as pd
 from time import ctime
-from copy import deepcopy as dc
 
-from random import uniform
-from propose import transistion
-from score import score_plan
-from score import score_contig
-from score import score_pop
+from rng import ChainRNG
+from compiled import CompiledGraph
+from propose import PROPOSALS
+from score import score_flip
+from score import score_moves
+from state import PlanState
+from reject import legal_state
+from store import PlanStore
+from store import PlanReservoir
+from store import DwellStore
+from log import ChainLog
+from log import save_checkpoint
+from log import load_checkpoint
+from utils import materialise
+from utils import plan_sig
+from diagnostics import Diagnostics
+
+
+# Fewest iterations before a chain can stop on its effective sample size
+MIN_ESS_ITERS = 10000
 
 
 # Markov Chain Simulation
-def chain(init_plan, n, const, fname):
+def chain(
+    init_plan,
+    n,
+    const,
+    fname,
+    constrained=False,
+    log_chunk=500000,
+    ckpt=None,
+    ckpt_every=100000,
+    rng=None,
+    proposal="flip",
+    diag=None,
+    target_ess=None,
+    target_unique=None,
+    budget=None,
+    thin=None,
+    reservoir=None,
+    weighted=False,
+    compiled=None,
+):
     """ Markov chain function for computing new redistricting plans based off
-    of an initial districting, an iteration count, and a constant value """
+    of an initial districting, an iteration count, and a constant value.
+    Returns a PlanStore of the plans kept from the chain, by default the
+    initial and every accepted plan. The chain itself is run by walk() """
+
+    if weighted and reservoir:
+        raise ValueError("A chain can't keep both a reservoir and weights")
+
+    # Random draws come from rng, a ChainRNG, freshly seeded if not given
+    if rng is None:
+        rng = ChainRNG()
+
+    # Compile the graph once for the chain and its store
+    if compiled is None:
+        compiled = CompiledGraph(init_plan)
+
+    # Accepted plans are stored as packed assignment vectors over the initial
+    # graph rather than as graphs. Thin keeps the plan the chain is in every
+    # thin iterations instead of every accepted plan. Reservoir keeps a
+    # uniform random sample of that many of the legal plans kept, so memory
+    # is fixed however long the chain runs; it draws from a stream spawned
+    # from rng, so the chain runs just as it would without it. Weighted keeps
+    # each distinct plan visited once, weighted by the number of iterations
+    # the chain stayed in it
+    if reservoir:
+        plans = PlanReservoir(init_plan, reservoir, rng.spawn(1)[0], compiled)
+        thin = thin or 1
+    elif weighted:
+        plans = DwellStore(init_plan, compiled=compiled)
+    else:
+        plans = PlanStore(init_plan, compiled=compiled)
+
+    # If a checkpoint file is given, the full chain state is saved to it every
+    # ckpt_every iterations and at the end, so the run can be picked up again
+    # with resume_chain()
+    def save(snapshot):
+        snapshot["plans"] = plans
+        save_checkpoint(snapshot, ckpt)
+
+    states = walk(
+        init_plan,
+        n,
+        const,
+        fname,
+        constrained,
+        log_chunk,
+        hook=save if ckpt else None,
+        every=ckpt_every,
+        rng=rng,
+        proposal=proposal,
+        diag=diag,
+        target_ess=target_ess,
+        target_unique=target_unique,
+        budget=budget,
+        thin=thin,
+        compiled=compiled,
+    )
+    keep(plans, states)
+
+    return plans
+
+
+def resume_chain(ckpt):
+    """ Picks up a chain() run from the checkpoint file it was saving to and
+    runs it to completion, continuing to checkpoint to the same file. The
+    chain's ChainRNG is restored with the rest of its state, so the run carries
+    on exactly as it would have without the interruption. Returns the
+    PlanStore of the whole run """
+
+    snapshot = load_checkpoint(ckpt)
+    plans = snapshot["plans"]
+
+    def save(snapshot):
+        snapshot["plans"] = plans
+        save_checkpoint(snapshot, ckpt)
+
+    # Rebuild the plan the chain was in from the base graph of its store
+    curr_plan = materialise(plans.graph, plans.nodes, snapshot["assign"])
+
+    states = walk(
+        curr_plan,
+        snapshot["n"],
+        snapshot["const"],
+        snapshot["fname"],
+        snapshot["constrained"],
+        hook=save,
+        every=snapshot["every"],
+        resume=snapshot,
+        proposal=snapshot.get("proposal", "flip"),
+        diag=snapshot.get("diag"),
+        target_ess=snapshot.get("target_ess"),
+        target_unique=snapshot.get("target_unique"),
+        budget=snapshot.get("budget"),
+        thin=snapshot.get("thin"),
+        compiled=plans.compiled,
+    )
+    keep(plans, states)
+
+    return plans
+
+
+def keep(plans, states):
+    """ Adds the plans yielded by walk() to a PlanStore. A PlanReservoir only
+    samples from the legal plans, and a DwellStore is told when the chain
+    arrives in each plan and when it finishes """
+
+    legal_only = isinstance(plans, PlanReservoir)
+    dwell = isinstance(plans, DwellStore)
+
+    # Step through by hand to get the last iteration walk() returns
+    while True:
+        try:
+            i, state = next(states)
+        except StopIteration as stop:
+            if dwell:
+                plans.finish(stop.value)
+            return
+
+        if dwell:
+            plans.visit(state.assign, i)
+        elif not legal_only or legal_state(state):
+            plans.append(state.assign)
+
+
+def walk(
+    init_plan,
+    n,
+    const,
+    fname,
+    constrained=False,
+    log_chunk=500000,
+    hook=None,
+    every=100000,
+    resume=None,
+    rng=None,
+    proposal="flip",
+    diag=None,
+    target_ess=None,
+    target_unique=None,
+    budget=None,
+    thin=None,
+    compiled=None,
+):
+    """ Generator form of the Markov chain. Yields the iteration number and
+    the chain's live PlanState, which consumers must copy from, for the
+    initial plan and after every accepted move (or every thin iterations).
+    Every iteration is logged to fname-<k>.parquet (see log.read_log()).
+    Returns the number of the last iteration run """
+
+    # Proposal function by name. Every proposal gives its transition
+    # probabilities in both directions, so the chain targets the same
+    # distribution whichever is used
+    if proposal not in PROPOSALS:
+        raise ValueError("Unknown proposal: {}".format(proposal))
+    propose = PROPOSALS[proposal]
 
     # While loop to control number of iterations
     i = 1
 
-    # Place initial graph at the start of list of graphs output by the chain
-    # and initialise it as the current plan
-    plans = [init_plan]
-    curr_plan = init_plan
+    # Persistent state holding the current plan as an assignment over the
+    # initial graph, along with per-district totals. Proposals are applied to
+    # it and rolled back in place, so the graph itself is never copied. It
+    # shares the CompiledGraph of init_plan if one is given
+    state = PlanState(init_plan, compiled)
+    legal = legal_state(state)
+    if (legal or not constrained) and not resume:
+        yield 0, state
 
-    # Create dict to hold all logging data. Key is the iteration number and
-    # values hold a list of logging data
-    log = {}
+    # Iteration log, written to disk in binary pieces of log_chunk records
+    log = ChainLog(fname, log_chunk)
 
     # Instantiate variables for logging
-    score_curr = 0
-    score_prop = 0
-    pop_curr = 0
-    pop_prop = 0
-    contig_curr = 0
-    contig_prop = 0
+    scores = {
+        "score_curr": 0,
+        "score_prop": 0,
+        "pop_curr": 0,
+        "pop_prop": 0,
+        "contig_curr": 0,
+        "contig_prop": 0,
+    }
     alpha = 0
     beta = 0
     flag = ""
-    lcount = 1
     start = timeit.default_timer()
 
+    # All random draws come from a ChainRNG, so chains are reproducible from
+    # a seed and parallel chains can be given independent streams
+    if rng is None:
+        rng = ChainRNG()
+
+    # The chain stops early once the smallest effective sample size of the
+    # statistics tracked by the diagnostics reaches target_ess, once it has
+    # visited target_unique distinct legal plans or once it has run for
+    # budget seconds. Distinct legal plans are counted by their signatures.
+    # Diagnostics kept only for target_ess don't write reports
+    if target_ess and diag is None:
+        diag = Diagnostics(every=None)
+    sigs = set() if target_unique else None
+    if sigs is not None and legal:
+        sigs.add(plan_sig(state.assign))
+
+    # Restore the loop and logging variables when carrying on from a snapshot
+    # handed to the hook, with init_plan set to the plan it was in
+    if resume:
+        i = resume["i"] + 1
+        legal = resume["legal"]
+        log = resume["log"]
+        scores = resume["scores"]
+        alpha = resume["alpha"]
+        beta = resume["beta"]
+        flag = resume["flag"]
+        start -= resume["runtime"]
+        rng = resume["rng"]
+        if sigs is not None:
+            sigs = resume.get("sigs", sigs)
+        if "order" in resume:
+            state.restore_order(resume["order"])
+
+    # A snapshot of a finished chain has nothing left to run
+    if resume and resume.get("done"):
+        return resume["i"]
+
+    def snapshot(i, done):
+        # Everything needed to carry on the chain after iteration i, for the
+        # hook to checkpoint every so many iterations and at the end
+        return {
+            "i": i,
+            "done": done,
+            "n": n,
+            "const": const,
+            "fname": fname,
+            "constrained": constrained,
+            "proposal": proposal,
+            "every": every,
+            "assign": list(state.assign),
+            "order": state.draw_order(),
+            "legal": legal,
+            "log": log,
+            "scores": scores,
+            "alpha": alpha,
+            "beta": beta,
+            "flag": flag,
+            "runtime": timeit.default_timer() - start,
+            "rng": rng,
+            "diag": diag,
+            "target_ess": target_ess,
+            "target_unique": target_unique,
+            "budget": budget,
+            "sigs": sigs,
+            "thin": thin,
+        }
+
     while i <= n:
 
-        # Get a proposal using transition() function
-        trans = transistion(curr_plan)
+        # Run one iteration of the chain
+        trans, curr_distr, flag, scored = step(
+            state, const, rng, propose, constrained, legal
+        )
+
+        # Keep the last scores for logging through repeats, which aren't
+        # scored
+        if scored:
+            scores, alpha, beta = scored
+
+        # Pass on the plan after each accepted move or, when thinning, every
+        # thin iterations whether it has moved or not, so plans keep the
+        # weighting of the time the chain spends in them. Constrained chains
+        # only pass on legal plans
+        if flag == "accept":
+            legal = scores["legal_prop"]
+            if sigs is not None and legal:
+                sigs.add(plan_sig(state.assign))
+            if not thin and (legal or not constrained):
+                yield i, state
+
+        if thin and i % thin == 0 and (legal or not constrained):
+            yield i, state
 
-        # Extract relevant bits from the transition() return
+        # Extract relevant bits from the transition() return for logging
         sourceNode = trans["node"]
         prop_distr = trans["prop_distr"]
         trans_out = trans["trans_out"]
         trans_in = trans["trans_in"]
 
-        # Get the current source node's district assignment
-        curr_distr = curr_plan.nodes[sourceNode]["distr"]
-
-        # If the proposal and current districts are different, we have a
-        # non-identical but adjacent plan, so proceed to acceptance probability
-        if prop_distr != curr_distr:
-
-            # Deep copy makes sure proposal is a new python object
-            prop_plan = dc(curr_plan)
-            # Set proposal district
-            prop_plan.nodes[sourceNode]["distr"] = prop_distr
-
-            # Score up both plans
-            score_curr = score_plan(curr_plan, const)
-            score_prop = score_plan(prop_plan, const)
-            pop_curr = score_pop(curr_plan)
-            pop_prop = score_pop(prop_plan)
-            contig_curr = score_contig(curr_plan)
-            contig_prop = score_contig(prop_plan)
-
-            # Compute acceptance
-            alpha = min(1, ((score_prop / score_curr) * (trans_in / trans_out)))
-            beta = uniform(0, 1)
-
-            # Accept or reject
-            if alpha > beta:
-                curr_plan = prop_plan
-                plans.append(curr_plan)
-                flag = "accept"
-            else:
-                flag = "reject"
-
-        # If the proposal and current districts are the same, then the plans
-        # are identical and we have a repeat
-        else:
-            flag = "repeat"
-
-        # Push logging variables to the logging dictionary after main body of
-        # iteration
-        log[i] = [
+        # Record logging variables after main body of iteration
+        log.record(
+            i,
             sourceNode,
             curr_distr,
             prop_distr,
-            round(score_curr, 3),
-            round(score_prop, 3),
-            round(pop_curr, 3),
-            round(pop_prop, 3),
-            round(contig_curr, 3),
-            round(contig_prop, 3),
-            round(trans_in, 3),
-            round(trans_out, 3),
-            round(alpha, 3),
-            round(beta, 3),
+            scores,
+            trans_in,
+            trans_out,
+            alpha,
+            beta,
             flag,
-        ]
+        )
 
         # Print some details of progress every 100 iterations
         if i % 100 == 0:
@@ -127,65 +363,138 @@ def chain(init_plan, n, const, fname):
                     file=f,
                 )
 
-        # Next two conditions handle the logging. Dumping the entire dictionary
-        # to csv proved to produce a massive file (4 million iterations after
-        # all). These conditionals dump the log dictionary to file at intervals
-        # of 1/8th of the total iteration count. Splitting them up into 8
-        # pieces makes for more manage file sizes
-
-        # After the very last iteration, dump the 8th and final log piece
-        if i == n:
-            df = pd.DataFrame.from_dict(
-                log,
-                orient="index",
-                columns=[
-                    "sourceNode",
-                    "currDistr",
-                    "propDistr",
-                    "scoreCurr",
-                    "scoreProp",
-                    "pop_curr",
-                    "pop_prop",
-                    "contig_curr",
-                    "contig_prop",
-                    "transIn",
-                    "transOut",
-                    "alpha",
-                    "beta",
-                    "outcome",
-                ],
-            )
-            df.to_csv("{}-{}.csv".format(fname, lcount))
-
-        # Dump the log dictionary to file after each successive 1/8th of
-        # iterations is complete. Off by one for the final iteration so that's
-        # handled above
-        if i % (n / 8) == 0:
-            df = pd.DataFrame.from_dict(
-                log,
-                orient="index",
-                columns=[
-                    "sourceNode",
-                    "currDistr",
-                    "propDistr",
-                    "scoreCurr",
-                    "scoreProp",
-                    "pop_curr",
-                    "pop_prop",
-                    "contig_curr",
-                    "contig_prop",
-                    "transIn",
-                    "transOut",
-                    "alpha",
-                    "beta",
-                    "outcome",
-                ],
+        # Track convergence diagnostics and write them out with the progress
+        # every diag.every iterations
+        if diag:
+            diag.update(state, flag)
+            if diag.every and i % diag.every == 0:
+                line = "{} | {}".format(ctime(), diag.report(i))
+                print(line)
+                with open("{}.txt".format(fname), "a+") as f:
+                    print(line, file=f)
+
+        # Stop early once any of the targets is reached
+        if i % 100 == 0:
+            reason = stop_reason(
+                i,
+                diag,
+                sigs,
+                timeit.default_timer() - start,
+                target_ess,
+                target_unique,
+                budget,
             )
+            if reason:
+                line = "{} | Stopping at iter {}: {}".format(ctime(), i, reason)
+                print(line)
+                with open("{}.txt".format(fname), "a+") as f:
+                    print(line, file=f)
+                break
 
-            df.to_csv("{}-{}.csv".format(fname, lcount))
-            lcount += 1
-            log = {}
+        # Hand a snapshot of the chain to the checkpoint hook
+        if hook and i % every == 0:
+            hook(snapshot(i, False))
 
         i += 1
 
-    return plans
+    # Write out whatever is left of the final log piece, and save a last
+    # checkpoint of the finished chain
+    log.flush()
+    last = min(i, n)
+    if hook:
+        hook(snapshot(last, True))
+
+    return last
+
+
+def stop_reason(i, diag, sigs, runtime, target_ess, target_unique, budget):
+    """ Checks a chain at iteration i against its early stopping targets: the
+    smallest effective sample size tracked by diag, the number of distinct
+    legal plan signatures in sigs and the runtime in seconds. Returns a
+    description of the first target reached, or None if the chain should
+    carry on """
+
+    # The effective sample size is nan until its batches are long enough to
+    # trust, and even then isn't checked before MIN_ESS_ITERS iterations
+    if target_ess and i >= MIN_ESS_ITERS and diag.min_ess() >= target_ess:
+        return "effective sample size {:.1f} reached".format(diag.min_ess())
+    if target_unique and len(sigs) >= target_unique:
+        return "{} unique legal plans reached".format(len(sigs))
+    if budget and runtime >= budget:
+        return "time budget of {}s reached".format(budget)
+
+    return None
+
+
+def step(state, const, rng, propose, constrained=False, legal=True):
+    """ Runs a single Metropolis-Hastings iteration of the chain on a
+    PlanState, which is moved in place if the proposal is accepted. Propose
+    is the proposal function and legal whether the state is in a legal plan,
+    for the constrained mode. Returns the proposal, the current
+    district of its source node, the flag for the outcome and, for proposals
+    that were scored, a tuple of the scores, alpha and beta (None for a
+    repeat) """
+
+    # Get a proposal using the selected proposal function
+    trans = propose(state, rng)
+
+    # Extract relevant bits from the transition() return
+    sourceNode = trans["node"]
+    prop_distr = trans["prop_distr"]
+    trans_out = trans["trans_out"]
+    trans_in = trans["trans_in"]
+    moves = trans.get("moves")
+
+    # Get the current source node's district assignment
+    curr_distr = state.assign[state.index[sourceNode]]
+
+    # If the proposal and current districts are the same, then the plans are
+    # identical and we have a repeat
+    if prop_distr == curr_distr:
+        return trans, curr_distr, "repeat", None
+
+    # Otherwise we have a non-identical but adjacent plan, so proceed to
+    # acceptance probability. Score up both plans. Proposals which move
+    # several nodes at once list them as moves
+    if moves:
+        scores = score_moves(state, moves, const, legal_state)
+    else:
+        scores = score_flip(state, sourceNode, prop_distr, const, legal_state)
+
+    # In constrained mode, a move out of the legal set is rejected before it
+    # reaches the acceptance test. Staying put instead is the Metropolis-
+    # Hastings chain for the score restricted to legal plans, so samples keep
+    # the correct weighting. A chain started from an illegal plan moves
+    # freely until it first reaches a legal one
+    if constrained and legal and not scores["legal_prop"]:
+        return trans, curr_distr, "illegal", (scores, 0, 0)
+
+    # Compute acceptance. Proposals whose transition probabilities are too
+    # large or small for a float, such as ReCom's, give their ratio as a log
+    ratio = scores["score_prop"] / scores["score_curr"]
+    if "log_ratio" in trans:
+        log_ratio = trans["log_ratio"]
+        log_accept = log_ratio + (math.log(ratio) if ratio > 0 else -math.inf)
+        if math.isnan(log_accept):
+            accept = math.nan
+        else:
+            accept = math.exp(min(log_accept, 0))
+    else:
+        accept = ratio * (trans_in / trans_out)
+
+    # min() passes a ratio that isn't a number through as 1, so reject it
+    # here rather than accept every such proposal
+    alpha = 0 if math.isnan(accept) else min(1, accept)
+    beta = rng.uniform()
+
+    # Accept or reject
+    if alpha > beta:
+        if moves:
+            state.reassign(moves)
+        else:
+            state.flip(sourceNode, prop_distr)
+        flag = "accept"
+    else:
+        flag = "reject"
+
+    return trans, curr_distr, flag, (scores, alpha, beta)
@@ -0,0 +1,53 @@
+#!/usr/bin/env python
+""" Array form of a districting graph. The networkx graph is compiled once
+into CSR-style adjacency arrays and flat node attribute arrays, which the
+chain's proposal, scoring and contiguity code work from instead of the
+dict-of-dicts graph """
+
+import numpy as np
+
+
+class CompiledGraph:
+    """ Immutable compiled form of a networkx districting graph. Nodes are
+    numbered 0..n-1 in sorted node order. The neighbours of node i are
+    indices[indptr[i]:indptr[i + 1]], and pop, vote_circ and vote_sqre hold
+    the node attributes. Nothing here depends on the district assignment, so
+    one compiled graph is made when a chain starts and is shared by its
+    PlanState, its PlanStore and the stores filtered from it """
+
+    def __init__(self, graph):
+        self.nodes = sorted(graph.nodes)
+        self.index = {node: i for i, node in enumerate(self.nodes)}
+
+        # CSR adjacency. Neighbours are kept in networkx's order
+        indices = []
+        indptr = [0]
+        for node in self.nodes:
+            indices.extend(self.index[n] for n in graph.neighbors(node))
+            indptr.append(len(indices))
+        self.indptr = np.array(indptr, dtype=np.int32)
+        self.indices = np.array(indices, dtype=np.int32)
+        self.degree = np.diff(self.indptr)
+
+        # Flat node attribute arrays
+        for attr in ["pop", "vote_circ", "vote_sqre"]:
+            values = [graph.nodes[n][attr] for n in self.nodes]
+            setattr(self, attr, np.array(values, dtype=np.int64))
+
+        # Per-node neighbour lists sliced from the CSR arrays. The chain's hot
+        # loop works one node at a time, and indexing plain lists from python
+        # is several times quicker than indexing NumPy arrays element by
+        # element, so these are made once here
+        self.nbors = [
+            self.indices[self.indptr[i] : self.indptr[i + 1]].tolist()
+            for i in range(len(self.nodes))
+        ]
+
+    def __len__(self):
+        return len(self.nodes)
+
+    def assignment(self, graph):
+        """ Returns the district assignments of a networkx graph over the same
+        nodes as a list ordered to match the compiled nodes """
+
+        return [graph.nodes[n]["distr"] for n in self.nodes]
@@ -0,0 +1,230 @@
+#!/usr/bin/env python
+""" Online convergence diagnostics for the Markov chain. Summary statistics
+of the chain's plan are tracked as it runs, giving their effective sample
+size from batch means and, across parallel chains, the Gelman-Rubin R-hat """
+
+# Imports
+from math import nan
+from math import sqrt
+from queue import Empty
+from time import ctime
+
+
+# Statistics tracked for each iteration of the chain
+STATS = ["pop_var", "seats_circ", "seats_sqre", "accept"]
+
+
+class BatchMeans:
+    """ Streaming mean, variance and batch means of a series of values. Values
+    are grouped into batches, and when the number of batches reaches twice
+    the target count neighbouring batches are merged and the batch size
+    doubled, so the batch size grows with the length of the series while
+    memory stays fixed """
+
+    def __init__(self, batches=32):
+        self.batches = batches
+        self.size = 1
+        self.means = []
+        self.batch_sum = 0
+        self.batch_n = 0
+
+        # Running count, mean and sum of squared deviations (Welford)
+        self.n = 0
+        self.mean = 0
+        self.m2 = 0
+
+    def add(self, x):
+        """ Add a value to the series """
+
+        self.n += 1
+        delta = x - self.mean
+        self.mean += delta / self.n
+        self.m2 += delta * (x - self.mean)
+
+        self.batch_sum += x
+        self.batch_n += 1
+        if self.batch_n == self.size:
+            self.means.append(self.batch_sum / self.size)
+            self.batch_sum = 0
+            self.batch_n = 0
+
+            if len(self.means) == 2 * self.batches:
+                pairs = zip(self.means[::2], self.means[1::2])
+                self.means = [(a + b) / 2 for a, b in pairs]
+                self.size *= 2
+
+    def var(self):
+        """ Sample variance of the series """
+
+        if self.n < 2:
+            return nan
+
+        return self.m2 / (self.n - 1)
+
+    def ess(self):
+        """ Effective sample size of the series, the number of values over
+        the ratio of the variance of the batch means (scaled up by the batch
+        size) to the variance of the values. Returns nan while the batches are
+        too short to trust, or if the series hasn't varied """
+
+        # Batches much shorter than the correlation length of the series look
+        # nearly independent and put the estimate near n over the batch size
+        # however correlated it is. As in the usual batch means estimator,
+        # wait until batches are at least the square root of the series long
+        m = len(self.means)
+        var = self.var()
+        if m < 2 or self.size < sqrt(self.n) or not var:
+            return nan
+
+        batch_mean = sum(self.means) / m
+        batch_var = sum((b - batch_mean) ** 2 for b in self.means) / (m - 1)
+        if not batch_var:
+            return nan
+
+        return min(self.n, self.n * var / (self.size * batch_var))
+
+
+class Diagnostics:
+    """ Tracks the statistics in STATS for every iteration of a chain:
+    population variance and seats won by each party in the current plan, and
+    whether the iteration's proposal was accepted. Plans stay put through
+    rejections and repeats, so those iterations count the same plan again.
+    A summary is reported every so many iterations, or never if every is
+    None, and is also put on queue if one is given, tagged with the chain
+    number, for monitor() to compare across chains """
+
+    def __init__(self, every=10000, batches=32, queue=None, chain=1):
+        self.every = every
+        self.queue = queue
+        self.chain = chain
+        self.stats = {name: BatchMeans(batches) for name in STATS}
+        self.values = None
+
+    def update(self, state, flag):
+        """ Add an iteration with the supplied outcome flag, leaving the chain
+        in the plan held by the PlanState """
+
+        # The plan's statistics only need working out again after a move
+        if flag == "accept" or self.values is None:
+            self.values = plan_stats(state)
+
+        for name, value in self.values.items():
+            self.stats[name].add(value)
+        self.stats["accept"].add(flag == "accept")
+
+    def summary(self):
+        """ Returns a dict of the count, mean, variance and effective sample
+        size of each statistic """
+
+        return {name: (s.n, s.mean, s.var(), s.ess()) for name, s in self.stats.items()}
+
+    def min_ess(self):
+        """ Smallest effective sample size of the plan's statistics, leaving
+        out acceptance, which isn't a property of the plans sampled, and any
+        statistic which hasn't varied. Returns nan if there are none """
+
+        ess = [s.ess() for name, s in self.stats.items() if name != "accept"]
+        ess = [x for x in ess if x == x]
+        if not ess:
+            return nan
+
+        return min(ess)
+
+    def report(self, i):
+        """ Summarise the statistics at iteration i, putting the summary on
+        the queue if there is one. Returns a line for the progress log """
+
+        summary = self.summary()
+        if self.queue is not None:
+            self.queue.put((self.chain, i, summary))
+
+        return "diag | iter:{:.>10} | {}".format(
+            i,
+            " | ".join(
+                "{} mean:{:.4g} ess:{:.1f}".format(name, mean, ess)
+                for name, (_, mean, _, ess) in summary.items()
+            ),
+        )
+
+    def __getstate__(self):
+        # The queue belongs to the run that made it and isn't saved with
+        # checkpoints
+        state = dict(self.__dict__)
+        state["queue"] = None
+        return state
+
+
+def plan_stats(state):
+    """ Returns the population variance and seats won by each party of the
+    plan held by a PlanState """
+
+    seats_circ = 0
+    seats_sqre = 0
+    for distr in state.distrs:
+        if state.distr_circ[distr] > state.distr_sqre[distr]:
+            seats_circ += 1
+        elif state.distr_sqre[distr] > state.distr_circ[distr]:
+            seats_sqre += 1
+
+    return {
+        "pop_var": state.pop_var(),
+        "seats_circ": seats_circ,
+        "seats_sqre": seats_sqre,
+    }
+
+
+def rhat(summaries):
+    """ Gelman-Rubin potential scale reduction factor of a statistic across
+    chains, from a list of each chain's (count, mean, variance). Values near
+    1 mean the chains agree. Whole chains are used, burn-in included, which
+    errs towards a larger R-hat. Returns nan if the chains haven't varied """
+
+    m = len(summaries)
+    n = min(s[0] for s in summaries)
+    means = [s[1] for s in summaries]
+    within = sum(s[2] for s in summaries) / m
+    if m < 2 or n < 2 or not within:
+        return nan
+
+    grand = sum(means) / m
+    between = n * sum((x - grand) ** 2 for x in means) / (m - 1)
+    pooled = (n - 1) / n * within + between / n
+
+    return sqrt(pooled / within)
+
+
+def monitor(queue, k, fname, done):
+    """ Reads the summaries that k parallel chains put on queue and, once
+    every chain has reported for an iteration, writes the R-hat of each
+    statistic to fname.txt and stdout. Carries on until the done function
+    returns True and the queue is empty. Returns a dict of the R-hats at each
+    reported iteration """
+
+    reports = {}
+    rhats = {}
+
+    while True:
+        try:
+            chain, i, summary = queue.get(timeout=1)
+        except Empty:
+            if done():
+                break
+            continue
+
+        reports.setdefault(i, {})[chain] = summary
+        if len(reports[i]) < k:
+            continue
+
+        chains = reports.pop(i).values()
+        rhats[i] = {name: rhat([chain[name][:3] for chain in chains]) for name in STATS}
+
+        line = "{} | rhat | iter:{:.>10} | {}".format(
+            ctime(),
+            i,
+            " | ".join("{}:{:.4f}".format(name, r) for name, r in rhats[i].items()),
+        )
+        print(line)
+        with open("{}.txt".format(fname), "a+") as f:
+            print(line, file=f)
+
+    return rhats
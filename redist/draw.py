@@ -8,6 +8,7 @@ import matplotlib.pyplot as plt
 import numpy as np
 import matplotlib
 from utils import distr_count
+from utils import cut_edges
 
 
 mpl.rcParams["font.family"] = ["sans-serif"]  # fancy fonts
@@ -193,6 +194,36 @@ def distr_plot_params(graph, stat, colour="blue", flat=False):
     return labels, sizes, col_map
 
 
+def edge_plot_params(graph, cut=None, colour="blue"):
+    """ Generate lists of edge plotting parameters which pick out district
+    boundaries. Cut edges, those joining nodes in different districts, are
+    drawn dark and thick and all other edges light and thin. Cut is an
+    optional list of the cut edges, such as from PlanState.cut_pairs(), and is
+    found by scanning the graph if not supplied. Returns lists of edges,
+    colours and widths, in that order, for nx.draw()'s edgelist, edge_color
+    and width arguments """
+
+    # Colour palette and edge widths for uncut and cut edges
+    col_pal = colour_scale(colour)
+    width_pal = {False: 2, True: 8}
+
+    if cut is None:
+        cut = cut_edges(graph)
+    cut = {frozenset(edge) for edge in cut}
+
+    # Empty lists of main plot parameters to be populated
+    elist = list(graph.edges)
+    col_map = []
+    widths = []
+
+    for edge in elist:
+        is_cut = frozenset(edge[:2]) in cut
+        col_map.append(col_pal[5] if is_cut else col_pal[1])
+        widths.append(width_pal[is_cut])
+
+    return elist, col_map, widths
+
+
 # Colour remapping function, used for heatmaps of vote margin
 # authors ="Paul H, Horea Christian"
 # https://github.com/TheChymera/chr-helpers
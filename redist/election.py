@@ -1,16 +1,29 @@
 #!/usr/bin/env python
 """ Source code for calculating voting totals and statistics"""
 
+import numpy as np
 import pandas as pd
 
-from utils import distr_count
-from utils import distr_nodes
+from utils import distr_stats
+from batch import batch_tally
+from batch import node_arrays
 
 
-def election(graph_list, fname=None):
+def election(graph_list, fname=None, weights=None):
     """ Accepts a list of graph(s) and computes results of an elections under
-    each districting plan in the list. Returns a dataframe of election results
-    """
+    each districting plan in the list. Returns a dataframe of election results.
+    Each plan's weight, the number of samples of the ensemble it stands for,
+    is given in the weight column; weights may be passed for the graphs, and
+    are otherwise 1. A PlanStore may be passed in place of the list, in which
+    case results are tallied for all plans at once, plans are identified by
+    their index in the store and its weights are used unless others are
+    passed """
+
+    if hasattr(graph_list, "matrix"):
+        return election_store(graph_list, fname, weights)
+
+    if weights is None:
+        weights = [1] * len(graph_list)
 
     results = {}
     i = 0
@@ -18,27 +31,29 @@ def election(graph_list, fname=None):
 
     # Iterate over each graph in the list
     for graph in graph_list:
-        num_distrs = distr_count(graph)
+        # Total up every district in one pass over the nodes
+        stats = distr_stats(graph)
+        num_distrs = len(stats)
         plan_id = id(graph)
         plan_label = pcount
 
         # Iterate over each district in the graph
         for distr in range(1, num_distrs + 1):
-            nodes = distr_nodes(distr, graph)
-            vote_circ = 0
-            vote_sqre = 0
-            total = 0
-
-            # Access individual nodes for their variable values and use them to
-            # calculate district totals
-            for node in nodes:
-                vote_circ += graph.nodes[node]["vote_circ"]
-                vote_sqre += graph.nodes[node]["vote_sqre"]
-                total += graph.nodes[node]["pop"]
+            vote_circ = stats[distr].vote_circ
+            vote_sqre = stats[distr].vote_sqre
+            total = stats[distr].pop
 
             # Each district result becomes an entry in a dictionary which gets
             # converted to a dataframe
-            results[i] = [plan_id, plan_label, distr, vote_circ, vote_sqre, total]
+            results[i] = [
+                plan_id,
+                plan_label,
+                distr,
+                vote_circ,
+                vote_sqre,
+                total,
+                weights[pcount],
+            ]
             i += 1
 
         pcount += 1
@@ -47,7 +62,15 @@ def election(graph_list, fname=None):
     df = pd.DataFrame.from_dict(
         results,
         orient="index",
-        columns=["plan_id", "plan_label", "distr", "vote_circ", "vote_sqre", "total"],
+        columns=[
+            "plan_id",
+            "plan_label",
+            "distr",
+            "vote_circ",
+            "vote_sqre",
+            "total",
+            "weight",
+        ],
     )
 
     # Write election results to specified file
@@ -55,3 +78,39 @@ def election(graph_list, fname=None):
         df.to_csv(fname)
 
     return df
+
+
+def election_store(store, fname=None, weights=None):
+    """ Vectorised version of election() for plans held in a PlanStore.
+    Returns a dataframe of election results with the same columns, weighted
+    by the store's weights or by weights if given """
+
+    if weights is None:
+        weights = store.plan_weights()
+    elif len(weights) != len(store):
+        raise ValueError(
+            "{} weights given for {} plans".format(len(weights), len(store))
+        )
+
+    tally = batch_tally(store.matrix(), node_arrays(store.compiled))
+    num_plans, num_distrs = tally["pop"].shape
+
+    # Lay the plans x districts totals out as one row per district of each
+    # plan, in the same order as election()
+    plan_ids = np.repeat(np.arange(num_plans), num_distrs)
+    df = pd.DataFrame(
+        {
+            "plan_id": plan_ids,
+            "plan_label": plan_ids,
+            "distr": np.tile(np.arange(1, num_distrs + 1), num_plans),
+            "vote_circ": tally["vote_circ"].ravel(),
+            "vote_sqre": tally["vote_sqre"].ravel(),
+            "total": tally["pop"].ravel(),
+            "weight": np.repeat(weights, num_distrs),
+        }
+    )
+
+    if fname:
+        df.to_csv(fname)
+
+    return df
@@ -3,6 +3,8 @@
 
 import networkx as nx
 
+from utils import set_pop_bounds
+
 
 def init_grid():
     """ Initialise graph """
@@ -184,6 +186,10 @@ def init_grid():
 
     gname.graph["position"] = pos
 
+    # Population bounds for legal districts are fixed by the graph, so compute
+    # them once here
+    set_pop_bounds(gname)
+
     return gname
 
 
@@ -565,6 +571,10 @@ def init_expanded():
     for n in list(graph.nodes):
         graph.nodes[n]["node label"] = n
 
+    # Population bounds for legal districts are fixed by the graph, so compute
+    # them once here
+    set_pop_bounds(graph)
+
     return graph
 
 
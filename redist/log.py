@@ -1,10 +1,44 @@
 #!/usr/bin/env python
 """ Functions for reading and writing networkx graphs to JSON files for logging
-purposes """
+purposes, the compact binary plan archive, and the binary iteration log
+written by the Markov chain """
 
+import os
 import json
+import pickle
+import numpy as np
+import pandas as pd
+from glob import glob
 from networkx.readwrite import json_graph
 
+from compiled import CompiledGraph
+from store import PlanStore
+from store import select
+
+
+# Column names and types of the chain's iteration log. Names match the columns
+# of the csv logs the chain used to write
+LOG_COLUMNS = [
+    ("iter", np.int64),
+    ("sourceNode", np.int32),
+    ("currDistr", np.uint8),
+    ("propDistr", np.uint8),
+    ("scoreCurr", np.float64),
+    ("scoreProp", np.float64),
+    ("pop_curr", np.float64),
+    ("pop_prop", np.float64),
+    ("contig_curr", np.int32),
+    ("contig_prop", np.int32),
+    ("transIn", np.float32),
+    ("transOut", np.float32),
+    ("alpha", np.float32),
+    ("beta", np.float32),
+    ("outcome", np.uint8),
+]
+
+# Outcome of each iteration is stored as a code rather than a string
+OUTCOMES = ["repeat", "accept", "reject", "illegal"]
+
 
 def to_json(glist, fname):
     """ Accepts a list of networkx graphs and dumps them to file for later
@@ -41,3 +75,240 @@ def from_json(fname):
         graphs.append(data)
 
     return graphs
+
+
+def to_archive(plans, fname):
+    """ Accepts a list of networkx graphs, or a PlanStore, and writes them to
+    a new plan archive. The archive is a set of files: fname.graph.json holds
+    the base graph once, fname.plans holds each plan as a packed row of uint8
+    district assignments, one per node in sorted node order, and
+    fname.weights holds the weight of each plan as an int64 """
+
+    graph = plans.graph if hasattr(plans, "matrix") else plans[0]
+
+    with open("{}.graph.json".format(fname), "w") as f:
+        json.dump(json_graph.adjacency_data(graph), f)
+
+    # Start with empty plans and weights files and append to them
+    open("{}.plans".format(fname), "wb").close()
+    open("{}.weights".format(fname), "wb").close()
+    append_archive(plans, fname)
+
+
+def append_archive(plans, fname):
+    """ Appends a list of networkx graphs, or a PlanStore, to the end of an
+    existing plan archive. Graphs are given a weight of 1 """
+
+    if hasattr(plans, "matrix"):
+        rows = plans.matrix()
+        weights = plans.plan_weights()
+    else:
+        rows = np.array(
+            [[g.nodes[n]["distr"] for n in sorted(g.nodes)] for g in plans],
+            dtype=np.uint8,
+        )
+        weights = np.ones(len(rows))
+
+    with open("{}.plans".format(fname), "ab") as f:
+        f.write(np.ascontiguousarray(rows, dtype=np.uint8).tobytes())
+    with open("{}.weights".format(fname), "ab") as f:
+        f.write(np.ascontiguousarray(weights, dtype=np.int64).tobytes())
+
+
+def open_archive(fname):
+    """ Opens a plan archive written by to_archive() for reading. Returns a
+    PlanArchive with the plans memory-mapped rather than loaded """
+
+    with open("{}.graph.json".format(fname)) as f:
+        graph = json_graph.adjacency_graph(json.load(f), multigraph=False)
+
+    # JSON turns the position dictionary's int keys into strings and tuples
+    # into lists, as in from_json()
+    graph.graph["position"] = {
+        int(key): tuple(value) for key, value in graph.graph["position"].items()
+    }
+
+    return PlanArchive(graph, "{}.plans".format(fname), "{}.weights".format(fname))
+
+
+class PlanArchive:
+    """ Read-only view of a plan archive. Plans are memory-mapped from disk as
+    a plans x nodes uint8 matrix, so opening an archive is cheap regardless of
+    its size. Only the plans asked for are materialised as networkx graphs:
+    an integer index gives a single graph, while a slice, list of indices or
+    boolean mask (e.g. built from batch.batch_tally() over matrix()) gives a
+    list of graphs. Like a PlanStore, the archive can be handed to
+    reject_by_pop(), remove_dups() and election() directly. Weights are read
+    from weights_path, and are all 1 for archives written without one """
+
+    def __init__(self, graph, path, weights_path=None):
+        self.graph = graph
+        self.compiled = CompiledGraph(graph)
+        self.nodes = self.compiled.nodes
+
+        # A memory map can't be made of an empty file
+        count = os.path.getsize(path) // len(self.nodes)
+        if count:
+            self.plans = np.memmap(
+                path, dtype=np.uint8, mode="r", shape=(count, len(self.nodes))
+            )
+        else:
+            self.plans = np.zeros((0, len(self.nodes)), dtype=np.uint8)
+
+        if count and weights_path and os.path.exists(weights_path):
+            self.weights = np.memmap(
+                weights_path, dtype=np.int64, mode="r", shape=(count,)
+            )
+        else:
+            self.weights = np.ones(count, dtype=np.int64)
+
+    def __len__(self):
+        return len(self.plans)
+
+    def __getitem__(self, key):
+        return select(self, key)
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    def assignment(self, i):
+        """ Returns the row of district assignments for plan i """
+
+        return self.plans[i]
+
+    def matrix(self):
+        """ Returns the memory-mapped plans x nodes matrix """
+
+        return self.plans
+
+    def plan_weights(self):
+        """ Returns the weights of the plans """
+
+        return self.weights
+
+    def take(self, indices):
+        """ Returns a PlanStore holding the plans at the supplied indices """
+
+        indices = np.asarray(indices, dtype=np.intp)
+        store = PlanStore(
+            self.graph, capacity=max(len(indices), 1), compiled=self.compiled
+        )
+        store.append_rows(self.plans[indices], self.weights[indices])
+
+        return store
+
+
+class ChainLog:
+    """ Iteration log for the Markov chain. Each iteration is written as a
+    fixed-width typed record into a preallocated buffer of chunk records.
+    When the buffer fills it is flushed to disk as a compressed Parquet
+    piece, fname-<k>.parquet, which R's arrow package reads directly """
+
+    def __init__(self, fname, chunk=500000):
+        self.fname = fname
+        self.chunk = chunk
+        self.buffer = np.zeros(chunk, dtype=LOG_COLUMNS)
+        self.size = 0
+        self.piece = 1
+        self.codes = {outcome: code for code, outcome in enumerate(OUTCOMES)}
+
+    def record(
+        self, i, node, curr, prop, scores, trans_in, trans_out, alpha, beta, flag
+    ):
+        """ Record a single iteration of the chain. Scores is a dict in the
+        form returned by score.score_flip() """
+
+        self.buffer[self.size] = (
+            i,
+            node,
+            curr,
+            prop,
+            scores["score_curr"],
+            scores["score_prop"],
+            scores["pop_curr"],
+            scores["pop_prop"],
+            scores["contig_curr"],
+            scores["contig_prop"],
+            trans_in,
+            trans_out,
+            alpha,
+            beta,
+            self.codes[flag],
+        )
+        self.size += 1
+
+        if self.size == self.chunk:
+            self.flush()
+
+    def __getstate__(self):
+        # Only the filled part of the buffer needs saving with a checkpoint
+        state = dict(self.__dict__)
+        state["buffer"] = self.buffer[: self.size].copy()
+
+        return state
+
+    def __setstate__(self, state):
+        records = state["buffer"]
+        self.__dict__.update(state)
+        self.buffer = np.zeros(self.chunk, dtype=LOG_COLUMNS)
+        self.buffer[: len(records)] = records
+
+    def flush(self):
+        """ Write the records held in the buffer to the next piece on disk and
+        empty the buffer """
+
+        if not self.size:
+            return
+
+        # Outcomes are written as a categorical, so they are stored as codes
+        # but read back as their names
+        records = self.buffer[: self.size]
+        df = pd.DataFrame({name: records[name] for name, _ in LOG_COLUMNS})
+        df["outcome"] = pd.Categorical.from_codes(df["outcome"], OUTCOMES)
+        df.to_parquet(
+            "{}-{}.parquet".format(self.fname, self.piece),
+            compression="zstd",
+            index=False,
+        )
+
+        self.piece += 1
+        self.size = 0
+
+
+def save_checkpoint(snapshot, fname):
+    """ Pickles a chain snapshot to the supplied checkpoint file. The snapshot
+    is written to a temporary file first and moved into place, so a crash
+    part way through writing leaves the previous checkpoint intact """
+
+    with open("{}.tmp".format(fname), "wb") as f:
+        pickle.dump(snapshot, f, protocol=pickle.HIGHEST_PROTOCOL)
+
+    os.replace("{}.tmp".format(fname), fname)
+
+
+def load_checkpoint(fname):
+    """ Loads a chain snapshot saved by save_checkpoint() """
+
+    with open(fname, "rb") as f:
+        return pickle.load(f)
+
+
+def read_log(fname):
+    """ Load every piece of a chain's binary iteration log into a single
+    dataframe indexed by iteration, with outcomes as strings """
+
+    # Pieces are numbered from 1. Skip any other files sharing the basename,
+    # such as the logs of other chains in a parallel run
+    pieces = {}
+    for piece in glob("{}-*.parquet".format(fname)):
+        number = piece[len(fname) + 1 : -len(".parquet")]
+        if number.isdigit():
+            pieces[int(number)] = piece
+
+    frames = [pd.read_parquet(pieces[number]) for number in sorted(pieces)]
+
+    df = pd.concat(frames, ignore_index=True).set_index("iter")
+    df["outcome"] = df["outcome"].astype(str)
+
+    return df
@@ -3,27 +3,313 @@
 
 # Imports
 import sys
+import argparse
 
 from init import init_expanded
 from chain import chain
+from chain import resume_chain
 from reject import reject_islands
 from reject import reject_by_pop
 from utils import remove_dups
 from election import election
-from log import to_json
+from log import to_archive
+from utils import set_pop_bounds
+from rng import ChainRNG
+from stream import pipeline
+from parallel import run_chains
+from parallel import merge
+from parallel import STARTS
+from propose import PROPOSALS
+from tempering import temper
+from diagnostics import Diagnostics
 
 
 def main():
     """ Main function """
 
+    parser = argparse.ArgumentParser(description="Run the redistricting chain")
+    parser.add_argument(
+        "--stream",
+        action="store_true",
+        help="filter, deduplicate and tally plans as the chain produces them",
+    )
+    parser.add_argument(
+        "--chains",
+        type=int,
+        default=1,
+        help="number of independent chains to run across a process pool",
+    )
+    parser.add_argument(
+        "--start",
+        nargs="+",
+        default=["expanded"],
+        choices=sorted(STARTS),
+        help="starting plan(s) for parallel chains, cycled through in order",
+    )
+    parser.add_argument(
+        "--seed",
+        type=int,
+        help="seed for the chain's random numbers (parallel chains are given "
+        "independent streams spawned from it)",
+    )
+    parser.add_argument(
+        "--constrained",
+        action="store_true",
+        help="reject illegal proposals in the chain so only legal plans are kept",
+    )
+    parser.add_argument(
+        "--tol",
+        type=float,
+        default=0.05,
+        help="population tolerance for legal districts, as a fraction of the "
+        "average district population",
+    )
+    parser.add_argument(
+        "--proposal",
+        default="flip",
+        choices=sorted(PROPOSALS),
+        help="proposal for the chain: flip any node, flip only nodes on a "
+        "district boundary, or recombine pairs of districts (ReCom)",
+    )
+    parser.add_argument(
+        "--temper",
+        nargs="+",
+        type=float,
+        metavar="CONST",
+        help="run parallel tempering over this ladder of score constants, one "
+        "replica process each. Plans are kept at the first constant",
+    )
+    parser.add_argument(
+        "--diagnostics",
+        type=int,
+        metavar="N",
+        help="track convergence diagnostics (effective sample sizes, and R-hat "
+        "across parallel chains) and write them to the log every N iterations",
+    )
+    parser.add_argument(
+        "--iters",
+        type=int,
+        default=4000000,
+        help="number of iterations to run, or the most to run when stopping "
+        "early on a target",
+    )
+    parser.add_argument(
+        "--target-ess",
+        type=float,
+        help="stop once the smallest effective sample size of the tracked "
+        "statistics reaches this",
+    )
+    parser.add_argument(
+        "--target-unique",
+        type=int,
+        help="stop once the chain has visited this many unique legal plans",
+    )
+    parser.add_argument(
+        "--budget",
+        type=float,
+        metavar="SECONDS",
+        help="stop once the chain has run for this long",
+    )
+    parser.add_argument(
+        "--thin",
+        type=int,
+        metavar="K",
+        help="keep the plan the chain is in every K iterations rather than "
+        "every accepted plan",
+    )
+    parser.add_argument(
+        "--reservoir",
+        type=int,
+        metavar="SIZE",
+        help="keep a fixed-size uniform random sample of the legal plans "
+        "visited, however long the chain runs",
+    )
+    parser.add_argument(
+        "--weighted",
+        action="store_true",
+        help="keep each plan visited once with the number of iterations the "
+        "chain spent in it as its weight, rather than every accepted plan",
+    )
+    parser.add_argument(
+        "--checkpoint",
+        metavar="FILE",
+        help="periodically save the chain's state to FILE, and again when it "
+        "finishes, so it can be resumed. Single chain runs only",
+    )
+    parser.add_argument(
+        "--checkpoint-every",
+        type=int,
+        default=100000,
+        metavar="N",
+        help="iterations between checkpoints",
+    )
+    parser.add_argument(
+        "--resume",
+        metavar="FILE",
+        help="carry on a run from the checkpoint saved in FILE",
+    )
+    args = parser.parse_args()
+
+    check_modes(parser, args)
+
     # Set basename for the run and initialise the first graph with the starting
     # plan
     basename = "4mil-const-pt0025-ban-ncontig-variance-fixed-distr1"
     S = init_expanded()
+    set_pop_bounds(S, args.tol)
+
+    # Pick up an interrupted run where its last checkpoint left off. All the
+    # chain's settings are restored from the checkpoint
+    if args.resume:
+        report(resume_chain(args.resume), basename)
+        return
+
+    # Track convergence of the chain as it runs, if asked, and stop it early
+    # once it reaches any of the targets given
+    diag = Diagnostics(args.diagnostics) if args.diagnostics else None
+    targets = {
+        "target_ess": args.target_ess,
+        "target_unique": args.target_unique,
+        "budget": args.budget,
+    }
+
+    # Plans kept from the chain. Thinning also applies to the streaming run,
+    # which has its own deduplicated store in place of a reservoir or weights
+    keep = {"thin": args.thin, "reservoir": args.reservoir, "weighted": args.weighted}
+
+    if args.stream:
+        stream_run(
+            S,
+            basename,
+            args.iters,
+            args.constrained,
+            ChainRNG(args.seed),
+            args.proposal,
+            diag,
+            dict(targets, thin=args.thin),
+        )
+        return
+
+    # Run replicas of the chain at each constant on the ladder, swapping
+    # constants between them, and keep the plans found at the first
+    if args.temper:
+        plans, _ = temper(
+            S,
+            args.iters,
+            args.temper,
+            "logs/{}".format(basename),
+            constrained=args.constrained,
+            rng=ChainRNG(args.seed),
+            proposal=args.proposal,
+        )
+        report(plans, basename)
+        return
+
+    # Run several chains in parallel, each with its own seed and logs, and
+    # merge their plans before filtering
+    if args.chains > 1:
+        stores = run_chains(
+            args.chains,
+            args.iters,
+            0.0025,
+            "logs/{}".format(basename),
+            starts=args.start,
+            seed=args.seed,
+            constrained=args.constrained,
+            tol=args.tol,
+            proposal=args.proposal,
+            diag_every=args.diagnostics,
+            **targets,
+            **keep,
+        )
+        report(merge(stores), basename)
+        return
 
     # Initiate the run with the starting graph, an iteration count, constant
-    # value, and log file
-    plans = chain(S, 4000000, 0.0025, "logs/{}".format(basename))
+    # value, and log file. Plans come back packed in a PlanStore and are only
+    # materialised as graphs once filtered down to the clean ones
+    plans = chain(
+        S,
+        args.iters,
+        0.0025,
+        "logs/{}".format(basename),
+        args.constrained,
+        ckpt=args.checkpoint,
+        ckpt_every=args.checkpoint_every,
+        rng=ChainRNG(args.seed),
+        proposal=args.proposal,
+        diag=diag,
+        **targets,
+        **keep,
+    )
+    report(plans, basename)
+
+
+def check_modes(parser, args):
+    """ Exits with an error if options are given that the chosen kind of run
+    would otherwise ignore """
+
+    given = {
+        "--stream": args.stream,
+        "--temper": args.temper,
+        "--chains": args.chains > 1,
+        "--diagnostics": args.diagnostics,
+        "--target-ess": args.target_ess,
+        "--target-unique": args.target_unique,
+        "--budget": args.budget,
+        "--thin": args.thin,
+        "--reservoir": args.reservoir,
+        "--weighted": args.weighted,
+        "--checkpoint": args.checkpoint,
+        "--constrained": args.constrained,
+        "--resume": args.resume,
+    }
+
+    # Options with a default count as given when set to something else
+    for flag in ["--start", "--seed", "--tol", "--proposal", "--iters"]:
+        dest = flag[2:]
+        given[flag] = getattr(args, dest) != parser.get_default(dest)
+    given["--checkpoint-every"] = args.checkpoint_every != parser.get_default(
+        "checkpoint_every"
+    )
+
+    # Options each kind of run can't be combined with. Checkpoints are only
+    # taken by a single chain() run, tempering keeps every plan visited at the
+    # target constant, and a resumed run takes all its settings from the
+    # checkpoint
+    unsupported = {
+        "--resume": [flag for flag in given if flag != "--resume"],
+        "--stream": [
+            "--temper",
+            "--chains",
+            "--reservoir",
+            "--weighted",
+            "--checkpoint",
+        ],
+        "--temper": [
+            "--chains",
+            "--diagnostics",
+            "--target-ess",
+            "--target-unique",
+            "--budget",
+            "--thin",
+            "--reservoir",
+            "--weighted",
+            "--checkpoint",
+        ],
+        "--chains": ["--checkpoint"],
+        "--reservoir": ["--weighted"],
+    }
+
+    for mode, flags in unsupported.items():
+        clash = [flag for flag in flags if given[mode] and given[flag]]
+        if clash:
+            parser.error("{} can't be used with {}".format(mode, ", ".join(clash)))
+
+
+def report(plans, basename):
+    """ Filters the plans from a run and writes out the legal plans and their
+    election results """
 
     # Log results, filter out illegal plans, remove duplicates, write legal
     # plans to file, and conduct and log election results
@@ -43,9 +329,56 @@ def main():
         )
 
         no_dups = remove_dups(apport)
-        to_json(no_dups, "plans/{}.json".format(basename))
+        to_archive(no_dups, "plans/{}".format(basename))
         election(no_dups, "elections/{}.csv".format(basename))
 
 
+def stream_run(
+    S,
+    basename,
+    n=4000000,
+    constrained=False,
+    rng=None,
+    proposal="flip",
+    diag=None,
+    targets=None,
+):
+    """ Streaming version of the run. Plans pass through rejection,
+    deduplication and election tallying as the chain accepts them, so election
+    results are written while the chain is still running and only clean,
+    unique plans are kept in memory. Targets is an optional dict of early
+    stopping targets and thinning for pipeline() """
+
+    plans, counts = pipeline(
+        S,
+        n,
+        0.0025,
+        "logs/{}".format(basename),
+        "elections/{}.csv".format(basename),
+        constrained=constrained,
+        rng=rng,
+        proposal=proposal,
+        diag=diag,
+        **(targets or {}),
+    )
+
+    with open("logs/{}.txt".format(basename), "a+") as f:
+        sys.stdout = f
+        print("\nRun complete.\n")
+
+        clean = counts["raw"] - counts["non-contiguous"] - counts["malapportioned"]
+
+        print("{} raw plans".format(counts["raw"]))
+        print("Kept {} clean plans".format(clean))
+        print(
+            "Rejected {} malapportioned plans and {} non-contiguous plans".format(
+                counts["malapportioned"], counts["non-contiguous"]
+            )
+        )
+        print("{} duplicate plans removed".format(counts["duplicate"]))
+
+        to_archive(plans, "plans/{}".format(basename))
+
+
 if __name__ == "__main__":
     main()
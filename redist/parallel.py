@@ -0,0 +1,149 @@
+#!/usr/bin/env python
+""" Run several independent Markov chains across a pool of processes and
+merge their output """
+
+# Imports
+from multiprocessing import Manager
+from multiprocessing import Pool
+from multiprocessing import cpu_count
+
+from init import init_expanded
+from init import gerry
+from chain import chain
+from compiled import CompiledGraph
+from store import PlanStore
+from utils import set_pop_bounds
+from rng import ChainRNG
+from diagnostics import Diagnostics
+from diagnostics import monitor
+
+
+# Starting plans available to the runner, keyed by name. Each is a function
+# returning a freshly initialised graph
+STARTS = {
+    "expanded": init_expanded,
+    "gerry": lambda: gerry(init_expanded()),
+}
+
+
+def run_chain(job):
+    """ Worker function for the process pool. Accepts a dict describing a
+    single chain (starting plan name, ChainRNG, iteration count, constant,
+    log file basename, whether it is constrained, the population tolerance,
+    the proposal, its early stopping targets, thinning, reservoir size,
+    whether to weight plans by dwell time, the shared CompiledGraph and, if
+    diagnostics are wanted, how often to report them and the queue to report
+    them on), runs it and returns its PlanStore """
+
+    init_plan = STARTS[job["start"]]()
+    set_pop_bounds(init_plan, job["tol"])
+
+    diag = None
+    if job["diag_every"]:
+        diag = Diagnostics(job["diag_every"], queue=job["queue"], chain=job["id"])
+
+    return chain(
+        init_plan,
+        job["n"],
+        job["const"],
+        job["fname"],
+        job["constrained"],
+        rng=job["rng"],
+        proposal=job["proposal"],
+        diag=diag,
+        target_ess=job["target_ess"],
+        target_unique=job["target_unique"],
+        budget=job["budget"],
+        thin=job["thin"],
+        reservoir=job["reservoir"],
+        weighted=job["weighted"],
+        compiled=job["compiled"],
+    )
+
+
+def run_chains(
+    k,
+    n,
+    const,
+    fname,
+    starts=("expanded",),
+    seed=None,
+    processes=None,
+    constrained=False,
+    tol=0.05,
+    proposal="flip",
+    diag_every=None,
+    target_ess=None,
+    target_unique=None,
+    budget=None,
+    thin=None,
+    reservoir=None,
+    weighted=False,
+):
+    """ Runs k independent chains of n iterations across a process pool,
+    cycling through the named starting plans in starts. The other options are
+    passed on to each chain as in chain.chain(). Returns a list of the
+    PlanStores produced by each chain """
+
+    # Each chain gets its own ChainRNG, spawned from seed so the streams are
+    # independent, and writes its own logs to fname-chain<j>
+    rngs = ChainRNG(seed).spawn(k)
+
+    # The starting plans differ only in their district assignments, so the
+    # graph is compiled once and shared by every chain
+    compiled = CompiledGraph(STARTS[starts[0]]())
+
+    # If diag_every is given, each chain reports its diagnostics every
+    # diag_every iterations, and the R-hat of each statistic across the chains
+    # is written to fname.txt (see diagnostics.monitor()). Chains report on a
+    # queue shared through a manager process, as plain queues can't be handed
+    # to pool workers
+    manager = Manager() if diag_every else None
+    queue = manager.Queue() if manager else None
+
+    jobs = []
+    for j in range(k):
+        jobs.append(
+            {
+                "start": starts[j % len(starts)],
+                "rng": rngs[j],
+                "n": n,
+                "const": const,
+                "fname": "{}-chain{}".format(fname, j + 1),
+                "constrained": constrained,
+                "tol": tol,
+                "proposal": proposal,
+                "id": j + 1,
+                "diag_every": diag_every,
+                "queue": queue,
+                "target_ess": target_ess,
+                "target_unique": target_unique,
+                "budget": budget,
+                "thin": thin,
+                "reservoir": reservoir,
+                "weighted": weighted,
+                "compiled": compiled,
+            }
+        )
+
+    with Pool(processes or min(k, cpu_count())) as pool:
+        result = pool.map_async(run_chain, jobs)
+        if queue is not None:
+            monitor(queue, k, fname, result.ready)
+        stores = result.get()
+
+    if manager:
+        manager.shutdown()
+
+    return stores
+
+
+def merge(stores):
+    """ Merges the PlanStores produced by several chains into a single
+    PlanStore, in chain order """
+
+    merged = PlanStore(stores[0].graph, compiled=stores[0].compiled)
+    for store in stores:
+        merged.extend(store)
+
+    return merged
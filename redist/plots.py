@@ -5,6 +5,8 @@
 from init import init_expanded
 from init import gerry
 from log import from_json
+from log import open_archive
+from log import to_archive
 from utils import distr_pop
 from utils import distr_count
 from utils import remove_dups
@@ -25,8 +27,12 @@ mpl.rcParams["font.sans-serif"] = ["Source Sans Pro"]
 def main():
     """ Main function """
 
-    # prod_run = from_json(
-    #     "plans/4mil-const-pt0025-ban-ncontig-variance-fixed-distr1.json"
+    # Plans are opened memory-mapped from their archive, and only the plans
+    # picked out by gerry_plans are materialised as graphs for drawing. Plans
+    # from older runs saved as JSON can be converted once with
+    # to_archive(from_json("plans/<run>.json"), "plans/<run>")
+    # prod_run = open_archive(
+    #     "plans/4mil-const-pt0025-ban-ncontig-variance-fixed-distr1"
     # )
     # gerry_plans = [
     #     276,
@@ -45,27 +51,24 @@ def main():
     #     1145,
     # ]
 
-    # count = 0
-    # for plan in prod_run:
-    #     if count in gerry_plans:
-    #         labs, sizes, colours = distr_plot_params(plan, "distr", "blue", flat=True)
-    #         pos = plan.graph["position"]
-    #         nlist = list(plan.nodes)
-
-    #         plt.figure(figsize=(19, 15))
-    #         nx.draw(
-    #             plan,
-    #             pos,
-    #             labels=labs,
-    #             node_list=nlist,
-    #             node_color=colours,
-    #             node_size=sizes,
-    #             font_size=40,
-    #             node_shape="o",
-    #             # cmap=plt.cm.RdYlGn,
-    #         )
-    #         plt.show()
-    #     count += 1
+    # for plan in prod_run[gerry_plans]:
+    #     labs, sizes, colours = distr_plot_params(plan, "distr", "blue", flat=True)
+    #     pos = plan.graph["position"]
+    #     nlist = list(plan.nodes)
+
+    #     plt.figure(figsize=(19, 15))
+    #     nx.draw(
+    #         plan,
+    #         pos,
+    #         labels=labs,
+    #         node_list=nlist,
+    #         node_color=colours,
+    #         node_size=sizes,
+    #         font_size=40,
+    #         node_shape="o",
+    #         # cmap=plt.cm.RdYlGn,
+    #     )
+    #     plt.show()
 
     S = init_expanded()
 
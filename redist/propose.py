@@ -1,28 +1,33 @@
 #!/usr/bin/env python
 """ Generate proposals for Markov chain """
 
-# Imports
-from random import randint as rint
+from math import exp
+from math import log
 
+import numpy as np
 
-def transistion(graph):
+
+def transistion(state, rng):
     """ Computes transition of a random source node to a new district and
     returns the proposed new district, the node, and its transition
-    probabilities in both directions """
+    probabilities in both directions. Reads district assignments from the
+    supplied PlanState, which is left untouched, and draws from the chain's
+    ChainRNG """
 
     # Acquire a source node at random from the full set of available nodes and
     # produce a list of districts of its neighbouring nodes
-    ncount = len(list(graph.nodes))
-    sourceNode = rint(1, ncount)
-    nbors = list(graph.neighbors(sourceNode))
+    ncount = len(state.nodes)
+    i = rng.randbelow(ncount)
+    sourceNode = state.nodes[i]
+    nbors = state.nbors[i]
     nbors_distrs = []
     for node in nbors:
-        nbors_distrs.append(graph.nodes[node]["distr"])
+        nbors_distrs.append(state.assign[node])
 
     # Log the current and proposed new districts for computing transition
     # probabilities and sending forward to acceptance probability
-    cur_distr = graph.nodes[sourceNode]["distr"]
-    prop_distr = nbors_distrs[rint(0, len(nbors_distrs) - 1)]
+    cur_distr = state.assign[i]
+    prop_distr = nbors_distrs[rng.randbelow(len(nbors_distrs))]
 
     # Compute 'outbound' transition probability as number of neighbours in the
     # proposed district over the total number of neighbours
@@ -40,3 +45,265 @@ def transistion(graph):
     }
 
     return trans
+
+
+def boundary_transistion(state, rng):
+    """ Computes transition of a random boundary node to a neighbouring
+    district and returns the same proposal as transistion(). Only nodes with
+    a neighbour in another district are drawn, from the boundary list kept
+    by the PlanState, and the proposed district is drawn from those
+    neighbours, so every proposal is a real move rather than a repeat """
+
+    # Acquire a source node at random from the boundary nodes, and the
+    # districts of its neighbours outside its own district
+    i = state.boundary[rng.randbelow(len(state.boundary))]
+    sourceNode = state.nodes[i]
+    cur_distr = state.assign[i]
+    nbors_distrs = [state.assign[n] for n in state.nbors[i]]
+    other_distrs = [d for d in nbors_distrs if d != cur_distr]
+    prop_distr = other_distrs[rng.randbelow(len(other_distrs))]
+
+    # Compute 'outbound' transition probability as the chance of drawing the
+    # node from the boundary times the share of its outside neighbours in the
+    # proposed district
+    #
+    # Compute 'inbound' transition as the same for the reverse move, back into
+    # the source district from the plan after the move. The boundary can grow
+    # or shrink with the move, so its size afterwards is worked out from the
+    # node's neighbourhood
+    trans_out = nbors_distrs.count(prop_distr) / (
+        len(other_distrs) * len(state.boundary)
+    )
+    back = nbors_distrs.count(cur_distr)
+    if back:
+        trans_in = back / (
+            (len(nbors_distrs) - nbors_distrs.count(prop_distr))
+            * state.boundary_after(i, prop_distr)
+        )
+    else:
+        trans_in = 0
+
+    trans = {
+        "node": sourceNode,
+        "prop_distr": prop_distr,
+        "trans_out": trans_out,
+        "trans_in": trans_in,
+    }
+
+    return trans
+
+
+def recom(state, rng):
+    """ Computes a reversible recombination (ReCom) proposal, which merges two
+    neighbouring districts and splits them along a legal cut of a random
+    spanning tree. Returns the same proposal as transistion(), with the node
+    moves as (node, district) pairs under "moves" and the log of the
+    transition ratio under "log_ratio" """
+
+    # Pick the two districts from a random cut edge, so that pairs of
+    # districts are drawn in proportion to the length of their shared border
+    a, b = state.cut_edges[rng.randbelow(len(state.cut_edges))]
+    distr_a = state.assign[a]
+    distr_b = state.assign[b]
+
+    trans = {
+        "node": state.nodes[a],
+        "prop_distr": distr_a,
+        "trans_out": 1,
+        "trans_in": 1,
+        "moves": [],
+    }
+
+    # Only pairs which could have come from a legal cut of a tree are split,
+    # which keeps the proposal reversible. Pairs which can't, and trees whose
+    # draw picks no cut below, are treated as repeats
+    for distr in [distr_a, distr_b]:
+        if not (state.contig[distr] and state.in_bounds(state.distr_pop[distr])):
+            return trans
+
+    merged = state.members[distr_a] | state.members[distr_b]
+    parent = spanning_tree(state, merged, rng)
+
+    # Total population below each node of the tree, built up from the leaves.
+    # The nodes are ordered so that every node comes after its parent
+    children = {i: [] for i in merged}
+    root = None
+    for i, p in parent.items():
+        if p is None:
+            root = i
+        else:
+            children[p].append(i)
+
+    order = [root]
+    for i in order:
+        order.extend(children[i])
+
+    below = {i: state.pop[i] for i in merged}
+    for i in reversed(order[1:]):
+        below[parent[i]] += below[i]
+
+    # Cutting the edge above a node splits off the subtree below it. Keep the
+    # cuts which leave both halves with a legal population, and pick one of
+    # the slots, which may be empty. Giving every legal cut the same fixed
+    # chance, rather than sharing the chance out between a tree's cuts, makes
+    # the chance of proposing a split a product of spanning tree counts, so
+    # the transition probabilities in both directions are exact and the chain
+    # targets the score like the other proposals
+    total = below[root]
+    cuts = [
+        i
+        for i in order[1:]
+        if state.in_bounds(below[i]) and state.in_bounds(total - below[i])
+    ]
+    slots = cut_slots(state, len(merged))
+    slot = rng.randbelow(slots)
+    if slot >= len(cuts):
+        return trans
+
+    half = [cuts[slot]]
+    for i in half:
+        half.extend(children[i])
+    half = set(half)
+    rest = merged - half
+
+    # Give each half the label of the district it overlaps the most, so the
+    # districts aren't needlessly relabelled. Ties are broken at random, and
+    # halve the chance of the split in either direction
+    keep = sum(state.assign[i] == distr_a for i in half)
+    keep += sum(state.assign[i] == distr_b for i in rest)
+    if keep == len(merged) - keep:
+        swap = rng.randbelow(2)
+    else:
+        swap = keep < len(merged) - keep
+    if swap:
+        distr_half, distr_rest = distr_b, distr_a
+    else:
+        distr_half, distr_rest = distr_a, distr_b
+
+    moves = []
+    for i in sorted(merged):
+        distr = distr_half if i in half else distr_rest
+        if state.assign[i] != distr:
+            moves.append((state.nodes[i], distr))
+
+    if not moves:
+        return trans
+
+    # The chance of a split is the chance of drawing the pair, times the
+    # number of (tree, edge) pairs of the merged area which give it over the
+    # number of trees times the slots. A
+    # split into areas A and B with k edges between them comes from
+    # trees(A) * trees(B) * k of them. The edges between the pair before and
+    # after the move are the same in both directions, as is everything to do
+    # with the merged area, but the number of cut edges changes
+    old_a = state.members[distr_a]
+    old_b = state.members[distr_b]
+    between_old = sum(1 for i in old_a for n in state.nbors[i] if n in old_b)
+    between_new = sum(1 for i in half for n in state.nbors[i] if n in rest)
+    cut_old = len(state.cut_edges)
+    cut_new = cut_old - between_old + between_new
+
+    # Tree counts run far past the range of a float on areas of a few hundred
+    # nodes, so the chances are built up as logs. The chain takes their ratio
+    # as log_ratio, and the chances themselves, which may underflow to 0, are
+    # only logged
+    pairs = log_tree_count(state, merged) + log(slots)
+    ties = log(2) if keep == len(merged) - keep else 0
+    log_out = (
+        log(between_old)
+        - log(cut_old)
+        + log_tree_count(state, half)
+        + log_tree_count(state, rest)
+        + log(between_new)
+        - pairs
+        - ties
+    )
+    log_in = (
+        log(between_new)
+        - log(cut_new)
+        + log_tree_count(state, old_a)
+        + log_tree_count(state, old_b)
+        + log(between_old)
+        - pairs
+        - ties
+    )
+    trans["trans_out"] = exp(log_out)
+    trans["trans_in"] = exp(log_in)
+    trans["log_ratio"] = log_in - log_out
+    trans["prop_distr"] = distr_b
+    trans["moves"] = moves
+
+    return trans
+
+
+def cut_slots(state, size):
+    """ Number of slots for the legal cuts of a spanning tree of a merged
+    area of size nodes, which must be at least as many as any tree can have.
+    When the population bounds are closer together than the lower bound,
+    every legal cut lies on one path of the tree with no more than the width
+    of the bounds in population between the first and last cut, which caps
+    the cuts by the population of the smallest node. Otherwise every edge of
+    the tree gets a slot """
+
+    slots = size - 1
+    smallest = min(state.pop)
+    if smallest > 0 and 2 * state.lower > state.upper:
+        slots = min(slots, 1 + (state.upper - state.lower) // smallest)
+
+    return max(slots, 1)
+
+
+def log_tree_count(state, area):
+    """ Log of the number of spanning trees of the connected area made up of
+    the supplied set of node indices, by Kirchhoff's theorem: the determinant
+    of its Laplacian matrix with one row and column removed """
+
+    nodes = sorted(area)
+    pos = {i: k for k, i in enumerate(nodes)}
+
+    laplacian = np.zeros((len(nodes), len(nodes)))
+    for i in nodes:
+        for n in state.nbors[i]:
+            if n in pos:
+                laplacian[pos[i], pos[i]] += 1
+                laplacian[pos[i], pos[n]] -= 1
+
+    # The minor is positive definite for a connected area, so only the log of
+    # the determinant's size is needed
+    return np.linalg.slogdet(laplacian[1:, 1:])[1]
+
+
+def spanning_tree(state, area, rng):
+    """ Draws a uniformly random spanning tree of the connected area made up
+    of the supplied set of node indices, using Wilson's algorithm of
+    loop-erased random walks. Returns the tree as a dict of each node's
+    parent, with None for the root """
+
+    area_nbors = {i: [n for n in state.nbors[i] if n in area] for i in area}
+    nodes = sorted(area)
+
+    root = nodes[rng.randbelow(len(nodes))]
+    parent = {root: None}
+
+    # Walk at random from each node not yet in the tree until the tree is
+    # reached. Only the last step out of each node visited is remembered,
+    # which erases any loops, and the walk is then added to the tree
+    for start in nodes:
+        step = {}
+        i = start
+        while i not in parent:
+            nbors = area_nbors[i]
+            step[i] = nbors[rng.randbelow(len(nbors))]
+            i = step[i]
+
+        i = start
+        while i not in parent:
+            parent[i] = step[i]
+            i = step[i]
+
+    return parent
+
+
+# Proposal functions by name, as selected with the proposal argument to
+# chain.chain()
+PROPOSALS = {"flip": transistion, "boundary": boundary_transistion, "recom": recom}
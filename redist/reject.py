@@ -2,23 +2,40 @@
 """ File containing functions to reject illegal districting plans produced by
 the Markov chain """
 
-from utils import distr_count
+import numpy as np
+
+from utils import distr_stats
 from utils import contig_distr
+from utils import subset
+from utils import pop_bounds
+from batch import batch_tally
+from batch import batch_contig
+from batch import node_arrays
 
 
 def reject_islands(plans):
     """ Accepts a plans list, containing a series of graphs of possible
     districting plans, and rejects any plans where at least one district is
     non-contiguous (i.e. has an island). Returns a list of plans with
-    non-contiguous plans removed """
+    non-contiguous plans removed. A PlanStore may be passed in place of the
+    list, in which case PlanStores are returned """
+
+    # Plans held in a PlanStore are checked all at once from their packed
+    # rows against the store's compiled graph, without building a graph for
+    # each
+    if hasattr(plans, "matrix"):
+        check = batch_contig(plans.matrix(), plans.compiled)
+
+        return plans.take(np.flatnonzero(check)), plans.take(np.flatnonzero(~check))
 
     clean_plans = []
     reject_plans = []
 
     # Get a districting plan (graph) from the list of plans
-    for graph in plans:
-        # Retrieve the number of districts in the given plan
-        num_distrs = distr_count(graph)
+    for idx, graph in enumerate(plans):
+        # Aggregate the plan's districts and retrieve their number
+        stats = distr_stats(graph)
+        num_distrs = len(stats)
 
         # Create an empty list to hold the boolean returns from contiguity
         # check
@@ -26,29 +43,43 @@ def reject_islands(plans):
 
         # Iterate through each distract in the plan
         for distr in range(1, num_distrs + 1):
-            graph_check.append(contig_distr(distr, graph))
+            graph_check.append(contig_distr(distr, graph, stats[distr].nodes))
 
         if False in graph_check:
-            reject_plans.append(graph)
+            reject_plans.append(idx)
         else:
-            clean_plans.append(graph)
+            clean_plans.append(idx)
 
-    return clean_plans, reject_plans
+    return subset(plans, clean_plans), subset(plans, reject_plans)
 
 
 def reject_by_pop(plans):
     """ Accepts a plans list, containing a series of graphs of possible
     districting plans, and rejects any plans where the population of any
-    district exceeds: total population * 1/number of districts (+/- 5%).
-    Returns a list of plans with non-contiguous plans removed """
+    district falls outside the bounds cached on the graph by
+    utils.set_pop_bounds() (by default total population * 1/number of
+    districts +/- 5%). Returns a list of plans with malapportioned plans
+    removed. A PlanStore may be passed in place of the list, in which case
+    PlanStores are returned """
+
+    # Plans held in a PlanStore are checked all at once from their packed rows
+    if hasattr(plans, "matrix"):
+        lower, upper = pop_bounds(plans.graph)
+        tally = batch_tally(plans.matrix(), node_arrays(plans.compiled))
+        check = ((tally["pop"] <= upper) & (tally["pop"] >= lower)).all(axis=1)
+
+        return plans.take(np.flatnonzero(check)), plans.take(np.flatnonzero(~check))
 
     clean_plans = []
     reject_plans = []
 
     # Get a districting plan (graph) from the list of plans
-    for graph in plans:
-        # Retrieve the number of districts in the given plan
-        num_distrs = distr_count(graph)
+    for idx, graph in enumerate(plans):
+        # Aggregate the plan's districts, and retrieve their number and the
+        # bounds on their populations
+        stats = distr_stats(graph)
+        num_distrs = len(stats)
+        lower, upper = pop_bounds(graph)
 
         # Create empty list to be populated with booleans for each district
         graph_check = []
@@ -59,23 +90,34 @@ def reject_by_pop(plans):
             # Assume pop. balance
             distr_check = True
 
-            nodes_in_distr = [
-                node for node, attrs in graph.nodes(data=True) if attrs["distr"] == i
-            ]
-            total_pop = 0
-            for node in nodes_in_distr:
-                total_pop += graph.nodes[node]["pop"]
+            total_pop = stats[i].pop
 
-            # Reject if district pop. is more than +/- 5% of average district
-            # pop (250)
-            if total_pop > 263 or total_pop < 237:
+            # Reject if district pop. is outside the bounds around the average
+            # district pop
+            if total_pop > upper or total_pop < lower:
                 distr_check = False
 
             graph_check.append(distr_check)
 
         if False in graph_check:
-            reject_plans.append(graph)
+            reject_plans.append(idx)
         else:
-            clean_plans.append(graph)
+            clean_plans.append(idx)
+
+    return subset(plans, clean_plans), subset(plans, reject_plans)
+
+
+def apport_state(state):
+    """ Accepts a PlanState and checks the population of every district
+    against the same bounds used by reject_by_pop(). The state keeps a running
+    count of districts outside the bounds, so this is O(1). Returns boolean
+    result """
+
+    return state.malapp == 0
+
+
+def legal_state(state):
+    """ Accepts a PlanState and checks that every district is contiguous and
+    within the population bound of reject_by_pop(). Returns boolean result """
 
-    return clean_plans, reject_plans
+    return state.all_contig() and apport_state(state)
@@ -0,0 +1,52 @@
+#!/usr/bin/env python
+""" Random number generation for the Markov chain. Each chain gets its own
+seedable generator rather than sharing the random module's global one """
+
+import numpy as np
+
+
+class ChainRNG:
+    """ Per-chain random number generator built on a NumPy Generator. Uniforms
+    are drawn in blocks and handed out one at a time, which avoids a python
+    call into the generator for every draw in the chain's hot loop. Integer
+    draws are made from the same block of uniforms. Independent streams for
+    parallel chains are made with spawn() """
+
+    def __init__(self, seed=None, block=8192):
+        # Seed may be an int, None (fresh entropy) or a SeedSequence
+        if isinstance(seed, np.random.SeedSequence):
+            self.seed_seq = seed
+        else:
+            self.seed_seq = np.random.SeedSequence(seed)
+
+        self.gen = np.random.Generator(np.random.PCG64(self.seed_seq))
+        self.block = block
+        self.buffer = []
+        self.pos = 0
+
+    def _refill(self):
+        # Converting to a list makes each draw a plain python float
+        self.buffer = self.gen.random(self.block).tolist()
+        self.pos = 0
+
+    def uniform(self):
+        """ Returns a uniform draw from [0, 1) """
+
+        if self.pos == len(self.buffer):
+            self._refill()
+
+        u = self.buffer[self.pos]
+        self.pos += 1
+
+        return u
+
+    def randbelow(self, n):
+        """ Returns a uniform random integer from 0 to n - 1 """
+
+        return int(self.uniform() * n)
+
+    def spawn(self, k):
+        """ Returns k new ChainRNGs with statistically independent streams,
+        for use by parallel chains """
+
+        return [ChainRNG(child, self.block) for child in self.seed_seq.spawn(k)]
@@ -5,8 +5,7 @@ contiguity and the full score which combines them """
 from math import exp as e
 from statistics import pstdev
 
-from utils import distr_count
-from utils import distr_pop
+from utils import distr_stats
 from utils import contig_distr
 
 
@@ -16,11 +15,14 @@ def score_plan(plan, const):
     score function takes the form of an energy function: e^-x. A parameterised
     constant is used to appropriately scale the results of the sub-scores """
 
+    # Aggregate the districts once for both sub-scores
+    stats = distr_stats(plan)
+
     # Get population score parameter
-    pop_param = score_pop(plan)
+    pop_param = score_pop(plan, stats)
 
     # Get contiguity score parameter
-    contig_param = score_contig(plan)
+    contig_param = score_contig(plan, stats)
 
     # Energy function with constant to adjust 'strength' of scoring
     score = e(-const * pop_param * contig_param)
@@ -28,19 +30,23 @@ def score_plan(plan, const):
     return score
 
 
-def score_pop(plan):
+def score_pop(plan, stats=None):
     """ Score a supplied plan for its population balance. That is, check the
-    population variance of each district from the ideal average. Returns a
-    variance value """
+    population variance of each district from the ideal average. The plan's
+    distr_stats() may be passed in if already computed. Returns a variance
+    value """
+
+    if stats is None:
+        stats = distr_stats(plan)
 
     # Retrieve the number of districts in the given plan and create empty list
     # for population values from each district
-    num_distrs = distr_count(plan)
+    num_distrs = len(stats)
     distr_pops = []
 
     for i in range(1, num_distrs + 1):
         # Tabulate population of each district and append to list
-        distr_pops.append(distr_pop(i, plan))
+        distr_pops.append(stats[i].pop)
 
     # pstdev is the standard library standard deviation function for an
     # iterable input
@@ -50,16 +56,19 @@ def score_pop(plan):
     return var
 
 
-def score_contig(plan):
+def score_contig(plan, stats=None):
     """ Scores a supplied plan based on the number of contiguous districts
-    present. If all are contiguous, returns 1; elsec returns 10^6 """
+    present. If all are contiguous, returns 1; elsec returns 10^6. The plan's
+    distr_stats() may be passed in if already computed """
 
-    num_distrs = distr_count(plan)
+    if stats is None:
+        stats = distr_stats(plan)
+    num_distrs = len(stats)
 
     # Build up a list of results for the contiguity test
     contig_list = []
     for i in range(1, num_distrs + 1):
-        contig_list.append(contig_distr(i, plan))
+        contig_list.append(contig_distr(i, plan, stats[i].nodes))
 
     # Count the number of disconnected districts and set score value
     if all(contig_list):
@@ -68,3 +77,73 @@ def score_contig(plan):
         score = 1000000
 
     return score
+
+
+def score_state(state, const):
+    """ Scores the plan held by a PlanState using its running district totals
+    rather than rescanning the graph. Returns the full score alongside the
+    population and contiguity sub-scores """
+
+    pop_param = state.pop_var()
+    if state.all_contig():
+        contig_param = 1
+    else:
+        contig_param = 1000000
+
+    score = e(-const * pop_param * contig_param)
+
+    return score, pop_param, contig_param
+
+
+def score_flip(state, node, distr, const, legal=None):
+    """ Scores the current plan held by a PlanState and the proposal made by
+    moving a single node into the supplied district. The move is applied to
+    the state, scored from the updated district totals, and then rolled back
+    so the state is left as it was found. If a legal function is supplied,
+    it is called on the state while the move is applied and its result is
+    returned as legal_prop """
+
+    score_curr, pop_curr, contig_curr = score_state(state, const)
+
+    token = state.flip(node, distr)
+    score_prop, pop_prop, contig_prop = score_state(state, const)
+    legal_prop = legal(state) if legal else None
+    state.undo(token)
+
+    scores = {
+        "score_curr": score_curr,
+        "score_prop": score_prop,
+        "pop_curr": pop_curr,
+        "pop_prop": pop_prop,
+        "contig_curr": contig_curr,
+        "contig_prop": contig_prop,
+        "legal_prop": legal_prop,
+    }
+
+    return scores
+
+
+def score_moves(state, moves, const, legal=None):
+    """ Scores the current plan held by a PlanState and the proposal made by
+    moving several nodes at once, given as (node, district) pairs. Works as
+    score_flip() does, applying the moves with PlanState.reassign() and then
+    rolling them back, and returns the same dict """
+
+    score_curr, pop_curr, contig_curr = score_state(state, const)
+
+    token = state.reassign(moves)
+    score_prop, pop_prop, contig_prop = score_state(state, const)
+    legal_prop = legal(state) if legal else None
+    state.undo_reassign(token)
+
+    scores = {
+        "score_curr": score_curr,
+        "score_prop": score_prop,
+        "pop_curr": pop_curr,
+        "pop_prop": pop_prop,
+        "contig_curr": contig_curr,
+        "contig_prop": contig_prop,
+        "legal_prop": legal_prop,
+    }
+
+    return scores
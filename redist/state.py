@@ -0,0 +1,404 @@
+#!/usr/bin/env python
+""" Persistent plan state for the Markov chain. Holds per-district totals so
+that single node moves can be scored from deltas instead of rescanning the
+full graph """
+
+from collections import deque
+
+from compiled import CompiledGraph
+from utils import materialise
+from utils import pop_bounds
+
+
+class IndexedSet:
+    """ A set which also keeps its items in a list with each item's position,
+    so that items can be added, removed and drawn at random by position in
+    O(1). Removing an item moves the last item into its place """
+
+    def __init__(self, items=()):
+        self.items = []
+        self.pos = {}
+        for item in items:
+            self.add(item)
+
+    def __len__(self):
+        return len(self.items)
+
+    def __contains__(self, item):
+        return item in self.pos
+
+    def __iter__(self):
+        return iter(self.items)
+
+    def __getitem__(self, k):
+        return self.items[k]
+
+    def add(self, item):
+        """ Add an item if it is not already present """
+
+        if item not in self.pos:
+            self.pos[item] = len(self.items)
+            self.items.append(item)
+
+    def discard(self, item):
+        """ Remove an item if it is present """
+
+        if item in self.pos:
+            pos = self.pos.pop(item)
+            last = self.items.pop()
+            if last != item:
+                self.items[pos] = last
+                self.pos[last] = pos
+
+
+class PlanState:
+    """ Tracks the district assignment of every node in a districting graph
+    alongside per-district population, vote totals, membership and
+    contiguity, and the district boundaries: the cut edges joining nodes in
+    different districts, the nodes they touch and each district's perimeter
+    as a count of its cut edges. Moving a single node between districts
+    updates these in O(degree) (plus a search of the district losing the node
+    for contiguity) """
+
+    def __init__(self, graph, compiled=None):
+        # Keep the graph the state was built from. It is shared rather than
+        # copied and never modified; the district assignment held in the state
+        # takes precedence over the "distr" attribute on its nodes
+        self.graph = graph
+
+        # Compile the graph into arrays, unless an already compiled one is
+        # being shared. Nodes are sorted so that positions in the flat lists
+        # below are stable regardless of networkx's iteration order
+        if compiled is None:
+            compiled = CompiledGraph(graph)
+        self.compiled = compiled
+        self.nodes = compiled.nodes
+        self.index = compiled.index
+
+        # Neighbour lists and node attributes from the compiled graph, as
+        # plain lists for quick access one node at a time
+        self.nbors = compiled.nbors
+        self.pop = compiled.pop.tolist()
+        self.vote_circ = compiled.vote_circ.tolist()
+        self.vote_sqre = compiled.vote_sqre.tolist()
+        self.assign = compiled.assignment(graph)
+
+        # Per-district totals and membership, built with a single pass over
+        # the nodes
+        self.distrs = sorted(set(self.assign))
+        self.distr_pop = {d: 0 for d in self.distrs}
+        self.distr_circ = {d: 0 for d in self.distrs}
+        self.distr_sqre = {d: 0 for d in self.distrs}
+        self.members = {d: set() for d in self.distrs}
+        for i, distr in enumerate(self.assign):
+            self.distr_pop[distr] += self.pop[i]
+            self.distr_circ[distr] += self.vote_circ[i]
+            self.distr_sqre[distr] += self.vote_sqre[i]
+            self.members[distr].add(i)
+
+        # Running totals used to compute the population variance from deltas
+        self.total_pop = sum(self.pop)
+        self.sum_sq = sum(p ** 2 for p in self.distr_pop.values())
+
+        # Population bounds for a legal district, cached on the graph, and a
+        # running count of districts outside them
+        self.lower, self.upper = pop_bounds(graph)
+        self.malapp = sum(1 for p in self.distr_pop.values() if not self.in_bounds(p))
+
+        # Contiguity flag for each district
+        self.contig = {d: self.distr_contig(d) for d in self.distrs}
+
+        # District boundaries. Cut edges are held as pairs of node indices,
+        # lowest first, and the boundary as the node indices they touch, both
+        # as IndexedSets so either can be drawn from at random. For each node
+        # the number of its neighbours in other districts is kept, and for
+        # each district the number of cut edges on its perimeter
+        self.cut_edges = IndexedSet()
+        self.boundary = IndexedSet()
+        self.cut = [0] * len(self.nodes)
+        self.perim = {d: 0 for d in self.distrs}
+        for i, distr in enumerate(self.assign):
+            for n in self.nbors[i]:
+                if self.assign[n] != distr:
+                    self.cut[i] += 1
+                    self.perim[distr] += 1
+                    if i < n:
+                        self.cut_edges.add((i, n))
+            if self.cut[i]:
+                self.boundary.add(i)
+
+    def distr_contig(self, distr):
+        """ Breadth-first search over the members of a single district to
+        determine if it is contiguous. Returns boolean result """
+
+        members = self.members[distr]
+
+        # An empty district is treated as non-contiguous, as in
+        # utils.contig_distr()
+        if not members:
+            return False
+
+        start = next(iter(members))
+        queue = deque([start])
+        visited = {start}
+
+        while queue:
+            curr = queue.popleft()
+            for n in self.nbors[curr]:
+                if n in members and n not in visited:
+                    visited.add(n)
+                    queue.append(n)
+
+        return len(visited) == len(members)
+
+    def removal_contig(self, i, distr):
+        """ Determines if a district which was contiguous is still contiguous
+        once node index i has been removed from it. Only the neighbourhood of
+        the removed node is examined where possible, with a breadth-first
+        search that stops as soon as it has linked up the removed node's
+        neighbours as a fallback. Returns boolean result """
+
+        members = self.members[distr]
+        d_nbors = [n for n in self.nbors[i] if n in members]
+
+        # No neighbours left in the district means the node was its only
+        # member, leaving it empty. A single neighbour means the node was a
+        # leaf of the district, which can't disconnect it
+        if not d_nbors:
+            return False
+        if len(d_nbors) == 1:
+            return True
+
+        # Local test: link up neighbours that are adjacent to one another or
+        # share a neighbour in the district. On planar precinct graphs the
+        # ring around the removed node usually joins them all up
+        group = {n: n for n in d_nbors}
+
+        def find(n):
+            while group[n] != n:
+                n = group[n]
+            return n
+
+        near = {n: {m for m in self.nbors[n] if m in members} for n in d_nbors}
+        for j, a in enumerate(d_nbors):
+            for b in d_nbors[j + 1 :]:
+                if b in near[a] or near[a] & near[b]:
+                    group[find(a)] = find(b)
+
+        if len({find(n) for n in d_nbors}) == 1:
+            return True
+
+        # Fallback: search the district from one neighbour until all the
+        # others have been reached, or the search runs out
+        targets = set(d_nbors)
+        targets.discard(d_nbors[0])
+        queue = deque([d_nbors[0]])
+        visited = {d_nbors[0]}
+
+        while queue:
+            curr = queue.popleft()
+            for n in self.nbors[curr]:
+                if n in members and n not in visited:
+                    visited.add(n)
+                    queue.append(n)
+                    targets.discard(n)
+                    if not targets:
+                        return True
+
+        return False
+
+    def flip(self, node, distr):
+        """ Move a single node into the supplied district, updating district
+        totals, membership and contiguity. Returns an undo token which can be
+        handed to undo() to roll the move back """
+
+        i = self.index[node]
+        old = self.assign[i]
+        token = (node, old, self.contig[old], self.contig[distr])
+
+        if old == distr:
+            return token
+
+        self._move(i, old, distr)
+
+        # The district losing the node is the only one that can be split by
+        # the move. The district gaining it stays contiguous as long as it was
+        # before and the node touches it
+        if self.contig[old]:
+            self.contig[old] = self.removal_contig(i, old)
+        else:
+            self.contig[old] = self.distr_contig(old)
+        if not (
+            self.contig[distr] and any(n in self.members[distr] for n in self.nbors[i])
+        ):
+            self.contig[distr] = self.distr_contig(distr)
+
+        return token
+
+    def undo(self, token):
+        """ Roll back a move made by flip() using the token it returned """
+
+        node, old, contig_old, contig_new = token
+        i = self.index[node]
+        distr = self.assign[i]
+
+        if old == distr:
+            return
+
+        self._move(i, distr, old)
+        self.contig[old] = contig_old
+        self.contig[distr] = contig_new
+
+    def reassign(self, moves):
+        """ Move several nodes at once, as (node, district) pairs, updating
+        district totals and membership and then rechecking contiguity of
+        every district involved. Returns an undo token which can be handed to
+        undo_reassign() to roll the moves back """
+
+        undo = []
+        changed = set()
+        for node, distr in moves:
+            i = self.index[node]
+            old = self.assign[i]
+            if old != distr:
+                self._move(i, old, distr)
+                undo.append((i, old))
+                changed.update((old, distr))
+
+        contig = {d: self.contig[d] for d in changed}
+        for d in changed:
+            self.contig[d] = self.distr_contig(d)
+
+        return undo, contig
+
+    def undo_reassign(self, token):
+        """ Roll back moves made by reassign() using the token it returned """
+
+        undo, contig = token
+        for i, old in reversed(undo):
+            self._move(i, self.assign[i], old)
+        self.contig.update(contig)
+
+    def _move(self, i, old, new):
+        """ Shift node index i from district old to district new, updating the
+        running totals """
+
+        p = self.pop[i]
+        pop_old = self.distr_pop[old]
+        pop_new = self.distr_pop[new]
+
+        self.sum_sq += (pop_old - p) ** 2 - pop_old ** 2
+        self.sum_sq += (pop_new + p) ** 2 - pop_new ** 2
+
+        self.distr_pop[old] = pop_old - p
+        self.distr_pop[new] = pop_new + p
+
+        self.malapp += self.in_bounds(pop_old) - self.in_bounds(pop_old - p)
+        self.malapp += self.in_bounds(pop_new) - self.in_bounds(pop_new + p)
+        self.distr_circ[old] -= self.vote_circ[i]
+        self.distr_circ[new] += self.vote_circ[i]
+        self.distr_sqre[old] -= self.vote_sqre[i]
+        self.distr_sqre[new] += self.vote_sqre[i]
+        self.members[old].discard(i)
+        self.members[new].add(i)
+        self.assign[i] = new
+
+        # Only the edges of the moved node can change between cut and uncut.
+        # Edges to the district it left become cut, edges to the district it
+        # joined stop being cut, and edges to any other district stay cut but
+        # move from the old district's perimeter to the new one's
+        for n in self.nbors[i]:
+            distr = self.assign[n]
+            edge = (i, n) if i < n else (n, i)
+            if distr == old:
+                self.cut_edges.add(edge)
+                self.perim[old] += 1
+                self.perim[new] += 1
+                self._set_cut(n, self.cut[n] + 1)
+            elif distr == new:
+                self.cut_edges.discard(edge)
+                self.perim[old] -= 1
+                self.perim[new] -= 1
+                self._set_cut(n, self.cut[n] - 1)
+            else:
+                self.perim[old] -= 1
+                self.perim[new] += 1
+        self._set_cut(i, sum(1 for n in self.nbors[i] if self.assign[n] != new))
+
+    def _set_cut(self, i, c):
+        """ Set the count of node index i's neighbours in other districts,
+        adding it to or dropping it from the boundary as needed """
+
+        if c:
+            self.boundary.add(i)
+        else:
+            self.boundary.discard(i)
+        self.cut[i] = c
+
+    def boundary_after(self, i, distr):
+        """ Number of boundary nodes there would be if node index i were moved
+        into the supplied district, worked out from its neighbourhood without
+        applying the move """
+
+        old = self.assign[i]
+        size = len(self.boundary)
+
+        if old == distr:
+            return size
+
+        for n in self.nbors[i]:
+            c = self.cut[n]
+            if self.assign[n] == old:
+                size += not c
+            elif self.assign[n] == distr:
+                size -= c == 1
+        c = sum(1 for n in self.nbors[i] if self.assign[n] != distr)
+        size += bool(c) - bool(self.cut[i])
+
+        return size
+
+    def in_bounds(self, pop):
+        """ Returns True if a district population is within the bounds """
+
+        return self.lower <= pop <= self.upper
+
+    def pop_var(self):
+        """ Population variance of the districts, as computed by
+        score.score_pop(), from the running sum of squares """
+
+        k = len(self.distrs)
+
+        return (k * self.sum_sq - self.total_pop ** 2) / k ** 2
+
+    def to_graph(self):
+        """ Materialise the plan held by the state as a networkx graph. The
+        graph is a copy of the one the state was built from with the current
+        district assignments written to each node """
+
+        return materialise(self.graph, self.nodes, self.assign)
+
+    def draw_order(self):
+        """ Returns the order in which the boundary nodes and cut edges are
+        held. It depends on the moves made to reach the plan and decides which
+        are picked by random draws, so it is saved with checkpoints """
+
+        return list(self.boundary), list(self.cut_edges)
+
+    def restore_order(self, order):
+        """ Put the boundary nodes and cut edges back in an order returned by
+        draw_order() for the same plan """
+
+        boundary, cut_edges = order
+        self.boundary = IndexedSet(boundary)
+        self.cut_edges = IndexedSet(tuple(edge) for edge in cut_edges)
+
+    def cut_pairs(self):
+        """ Returns the cut edges of the plan as pairs of nodes from the graph,
+        as used by draw.edge_plot_params() """
+
+        return [(self.nodes[a], self.nodes[b]) for a, b in self.cut_edges]
+
+    def all_contig(self):
+        """ Returns True if every district in the plan is contiguous """
+
+        return all(self.contig.values())
@@ -0,0 +1,218 @@
+#!/usr/bin/env python
+""" Compact in-memory storage of districting plans produced by the Markov
+chain. Plans are held as rows of district assignments over a single shared
+graph rather than as individual networkx graphs """
+
+from math import exp
+from math import floor
+from math import log
+
+import numpy as np
+
+from compiled import CompiledGraph
+from utils import materialise
+from utils import plan_sig
+
+
+def select(plans, key):
+    """ Indexing shared by PlanStore and PlanArchive. An integer key
+    materialises a single plan as a networkx graph. A slice, a sequence of
+    indices or a boolean mask over the plans materialises only the selected
+    plans, returned as a list of graphs """
+
+    if isinstance(key, (int, np.integer)):
+        return materialise(plans.graph, plans.nodes, plans.assignment(key))
+
+    indices = np.arange(len(plans))[key]
+
+    return [materialise(plans.graph, plans.nodes, plans.assignment(i)) for i in indices]
+
+
+class PlanStore:
+    """ Growable matrix of plans, one row per plan and one uint8 column per
+    node (nodes in sorted order), with a weight for each plan. Weights count
+    how many samples of the ensemble a plan stands for, 1 unless given (see
+    DwellStore). Indexing (see select()) or iterating the store materialises
+    networkx graphs on demand, so it can be handed to code expecting a list
+    of graphs. The store keeps the CompiledGraph of its base graph for the
+    vectorised checks in batch.py, and shares it with the stores taken from
+    it """
+
+    def __init__(self, graph, capacity=1024, compiled=None):
+        # Base graph shared by every plan in the store. Its own district
+        # assignments are ignored in favour of the stored rows
+        self.graph = graph
+        self.compiled = compiled or CompiledGraph(graph)
+        self.nodes = self.compiled.nodes
+        self.plans = np.zeros((capacity, len(self.nodes)), dtype=np.uint8)
+        self.weights = np.zeros(capacity, dtype=np.int64)
+        self.count = 0
+
+    def __len__(self):
+        return self.count
+
+    def __getitem__(self, key):
+        return select(self, key)
+
+    def __iter__(self):
+        for i in range(self.count):
+            yield self[i]
+
+    def append(self, assign, weight=1):
+        """ Append a plan, given as a sequence of district assignments ordered
+        to match the sorted nodes of the base graph, with its weight """
+
+        self._reserve(self.count + 1)
+        self.plans[self.count] = assign
+        self.weights[self.count] = weight
+        self.count += 1
+
+    def assignment(self, i):
+        """ Returns the row of district assignments for plan i """
+
+        if i < 0:
+            i += self.count
+        if not 0 <= i < self.count:
+            raise IndexError("plan index out of range")
+
+        return self.plans[i]
+
+    def matrix(self):
+        """ Returns a view of the filled rows of the plan matrix """
+
+        return self.plans[: self.count]
+
+    def plan_weights(self):
+        """ Returns a view of the weights of the plans """
+
+        return self.weights[: self.count]
+
+    def take(self, indices):
+        """ Returns a new PlanStore holding only the plans at the supplied
+        indices """
+
+        subset = PlanStore(
+            self.graph, capacity=max(len(indices), 1), compiled=self.compiled
+        )
+        subset.plans[: len(indices)] = self.plans[list(indices)]
+        subset.weights[: len(indices)] = self.weights[list(indices)]
+        subset.count = len(indices)
+
+        return subset
+
+    def extend(self, other):
+        """ Append every plan held in another PlanStore (or PlanArchive) over
+        the same nodes """
+
+        if other.nodes != self.nodes:
+            raise ValueError("plan stores are over different nodes")
+
+        self.append_rows(other.matrix(), other.plan_weights())
+
+    def append_rows(self, rows, weights=1):
+        """ Append a plans x nodes matrix of district assignments, with a
+        vector of their weights """
+
+        self._reserve(self.count + len(rows))
+        self.plans[self.count : self.count + len(rows)] = rows
+        self.weights[self.count : self.count + len(rows)] = weights
+        self.count += len(rows)
+
+    def _reserve(self, size):
+        """ Grow the plan matrix, doubling its capacity, until it can hold
+        size plans """
+
+        capacity = max(len(self.plans), 1)
+        if size <= len(self.plans):
+            return
+
+        while capacity < size:
+            capacity *= 2
+
+        grown = np.zeros((capacity, len(self.nodes)), dtype=np.uint8)
+        grown[: self.count] = self.plans[: self.count]
+        self.plans = grown
+
+        grown = np.zeros(capacity, dtype=np.int64)
+        grown[: self.count] = self.weights[: self.count]
+        self.weights = grown
+
+
+class PlanReservoir(PlanStore):
+    """ PlanStore holding a fixed-size uniform random sample of the plans
+    appended to it, however many there are, by reservoir sampling. Skips
+    between the plans taken are drawn directly (Algorithm L), so most appends
+    are just counted and random draws are only needed for the plans taken.
+    Draws come from rng, a ChainRNG. Plans are held in the order of their
+    slots in the reservoir rather than the order they were appended """
+
+    def __init__(self, graph, size, rng, compiled=None):
+        super().__init__(graph, capacity=size, compiled=compiled)
+        self.size = size
+        self.rng = rng
+        self.seen = 0
+        self.weight = 1
+        self.next = size
+
+    def append(self, assign, weight=1):
+        """ Offer a plan to the reservoir. The first size plans are all kept,
+        after which each plan replaces a random one already held with
+        probability size over the number of plans offered. Every plan offered
+        counts once, so weight is ignored """
+
+        self.seen += 1
+
+        if self.seen <= self.size:
+            super().append(assign)
+            if self.seen == self.size:
+                self._skip()
+        elif self.seen == self.next:
+            self.plans[self.rng.randbelow(self.size)] = assign
+            self._skip()
+
+    def _skip(self):
+        """ Draw the number of the next plan to be taken """
+
+        self.weight *= exp(log(1 - self.rng.uniform()) / self.size)
+        self.next += floor(log(1 - self.rng.uniform()) / log(1 - self.weight)) + 1
+
+
+class DwellStore(PlanStore):
+    """ PlanStore of the distinct plans visited by a chain, each held once and
+    weighted by its dwell time: the number of iterations the chain was in
+    it. Rejected and repeated proposals leave the chain where it is, so these
+    weights, rather than a count of acceptances, are what each plan counts
+    for in the chain's ensemble. The chain is in the plan it starts from at
+    iteration 0, so the weights of a run of n iterations add up to n + 1 """
+
+    def __init__(self, graph, capacity=1024, compiled=None):
+        super().__init__(graph, capacity, compiled)
+
+        # Row of each plan by signature, and the row of the plan the chain is
+        # in along with the iteration it arrived
+        self.rows = {}
+        self.current = None
+        self.since = 0
+
+    def visit(self, assign, i):
+        """ Record the chain arriving in a plan at iteration i, ending its
+        stay in the plan it was in before """
+
+        if self.current is not None:
+            self.weights[self.current] += i - self.since
+
+        sig = plan_sig(assign)
+        if sig not in self.rows:
+            self.rows[sig] = self.count
+            self.append(assign, 0)
+
+        self.current = self.rows[sig]
+        self.since = i
+
+    def finish(self, end):
+        """ End the stay in the current plan after the chain's last iteration,
+        end """
+
+        if self.current is not None:
+            self.weights[self.current] += end + 1 - self.since
+            self.current = None
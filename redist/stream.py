@@ -0,0 +1,188 @@
+#!/usr/bin/env python
+""" Streaming pipeline which passes plans from the Markov chain through
+contiguity rejection, population rejection, deduplication and election
+tallying as they are produced, rather than in separate passes over a list of
+plans once the chain has finished """
+
+import csv
+
+from chain import walk
+from compiled import CompiledGraph
+from reject import apport_state
+from store import PlanStore
+from utils import plan_sig
+
+
+def reject_islands_stream(states, counts):
+    """ Passes on plans from a stream of (iteration, PlanState) pairs only if
+    every district is contiguous. Rejections are tallied in counts """
+
+    for i, state in states:
+        counts["raw"] += 1
+        if state.all_contig():
+            yield i, state
+        else:
+            counts["non-contiguous"] += 1
+
+
+def reject_by_pop_stream(states, counts):
+    """ Passes on plans from a stream of (iteration, PlanState) pairs only if
+    every district is within the population bound of reject_by_pop().
+    Rejections are tallied in counts """
+
+    for i, state in states:
+        if apport_state(state):
+            yield i, state
+        else:
+            counts["malapportioned"] += 1
+
+
+def remove_dups_stream(states, counts, weights, seen=None):
+    """ Passes on plans from a stream of (iteration, PlanState) pairs only the
+    first time their district assignments are seen. Duplicates are tallied in
+    counts, and as with remove_dups() the weight of each duplicate is added to
+    the copy kept, held in weights under the iteration it was passed on. A
+    set of signatures from earlier runs can be passed as seen """
+
+    if seen is None:
+        seen = set()
+
+    # Iteration each plan kept in this run was passed on, so that its
+    # duplicates can be counted against it. Plans already seen in other runs
+    # are dropped outright
+    kept = {}
+    for i, state in states:
+        sig = plan_sig(state.assign)
+        if sig not in seen:
+            seen.add(sig)
+            kept[sig] = i
+            weights[i] = 1
+            yield i, state
+        else:
+            counts["duplicate"] += 1
+            if sig in kept:
+                weights[kept[sig]] += 1
+
+
+def election_stream(states, fname):
+    """ Tallies the election result of each plan in a stream of (iteration,
+    PlanState) pairs and appends it to a csv file with the same columns as
+    election(). The plan id is the chain iteration the plan was accepted on.
+    Rows are flushed as each plan arrives so results can be read while the
+    chain is still running, with a weight of 1 until reweight_csv() adds the
+    duplicates found later in the run """
+
+    with open(fname, "w", newline="") as f:
+        writer = csv.writer(f)
+        writer.writerow(
+            [
+                "",
+                "plan_id",
+                "plan_label",
+                "distr",
+                "vote_circ",
+                "vote_sqre",
+                "total",
+                "weight",
+            ]
+        )
+
+        row = 0
+        pcount = 0
+        for i, state in states:
+            for distr in state.distrs:
+                writer.writerow(
+                    [
+                        row,
+                        i,
+                        pcount,
+                        distr,
+                        state.distr_circ[distr],
+                        state.distr_sqre[distr],
+                        state.distr_pop[distr],
+                        1,
+                    ]
+                )
+                row += 1
+            f.flush()
+            pcount += 1
+
+            yield i, state
+
+
+def reweight_csv(fname, weights):
+    """ Rewrites the weight column of an election csv written by
+    election_stream() from a dict of plan weights keyed by plan id """
+
+    with open(fname, newline="") as f:
+        rows = list(csv.reader(f))
+
+    # The plan id is the second column and the weight the last
+    for row in rows[1:]:
+        row[-1] = weights[int(row[1])]
+
+    with open(fname, "w", newline="") as f:
+        csv.writer(f).writerows(rows)
+
+
+def pipeline(
+    init_plan,
+    n,
+    const,
+    fname,
+    elect_fname,
+    seen=None,
+    constrained=False,
+    rng=None,
+    proposal="flip",
+    diag=None,
+    target_ess=None,
+    target_unique=None,
+    budget=None,
+    thin=None,
+):
+    """ Runs the Markov chain with its accepted plans streamed through the
+    rejection, deduplication and election stages. Returns a PlanStore of the
+    clean, unique plans, each weighted by its duplicates, and a dict of counts
+    from each stage """
+
+    counts = {"raw": 0, "non-contiguous": 0, "malapportioned": 0, "duplicate": 0}
+    compiled = CompiledGraph(init_plan)
+
+    # The chain options and stopping targets are passed straight on to
+    # chain.walk(). Seen is an optional set of plan signatures from earlier
+    # runs to deduplicate against
+    states = walk(
+        init_plan,
+        n,
+        const,
+        fname,
+        constrained,
+        rng=rng,
+        proposal=proposal,
+        diag=diag,
+        target_ess=target_ess,
+        target_unique=target_unique,
+        budget=budget,
+        thin=thin,
+        compiled=compiled,
+    )
+    states = reject_islands_stream(states, counts)
+    states = reject_by_pop_stream(states, counts)
+    weights = {}
+    states = remove_dups_stream(states, counts, weights, seen)
+    states = election_stream(states, elect_fname)
+
+    ids = []
+    plans = PlanStore(init_plan, compiled=compiled)
+    for i, state in states:
+        plans.append(state.assign)
+        ids.append(i)
+
+    # Duplicates of a plan can turn up long after it was written out, so its
+    # weight is only final once the chain has finished. Weights then match
+    # those remove_dups() gives the same plans on the batch path
+    plans.weights[: plans.count] = [weights[i] for i in ids]
+    reweight_csv(elect_fname, weights)
+
+    return plans, counts
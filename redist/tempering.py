@@ -0,0 +1,229 @@
+#!/usr/bin/env python
+""" Parallel tempering (replica exchange) for the Markov chain. Several
+replicas of the chain run in their own processes at different values of the
+score constant, and neighbouring replicas periodically swap constants so that
+plans found by the freely wandering replicas can pass down to the target """
+
+# Imports
+import timeit
+from math import exp
+from time import ctime
+from multiprocessing import Pipe
+from multiprocessing import Process
+
+from chain import step
+from compiled import CompiledGraph
+from log import ChainLog
+from propose import PROPOSALS
+from reject import legal_state
+from rng import ChainRNG
+from score import score_state
+from state import PlanState
+from store import PlanStore
+
+
+def replica(conn, init_plan, fname, constrained, proposal, rng, log_chunk, compiled):
+    """ Worker process for a single replica. Holds the replica's PlanState and
+    runs rounds of the chain as asked for by temper() over conn. Each request
+    is a tuple of the constant to run at, the number of iterations, and
+    whether the replica is at the target constant and so should keep its
+    plans, and whether it has just arrived there. Sends back the energy of the
+    plan it ends up in along with the assignments of the plans it kept. A
+    request of None ends the worker. Every iteration is logged to a ChainLog
+    at fname. Compiled is the CompiledGraph shared by every replica """
+
+    state = PlanState(init_plan, compiled)
+    legal = legal_state(state)
+    propose = PROPOSALS[proposal]
+    log = ChainLog(fname, log_chunk)
+    i = 1
+
+    # Logging variables, kept through repeats as in chain.walk()
+    scores = {
+        "score_curr": 0,
+        "score_prop": 0,
+        "pop_curr": 0,
+        "pop_prop": 0,
+        "contig_curr": 0,
+        "contig_prop": 0,
+    }
+    alpha = 0
+    beta = 0
+
+    while True:
+        request = conn.recv()
+        if request is None:
+            break
+        const, steps, keep, arrived = request
+
+        # A replica arriving at the target constant brings a new plan with it
+        rows = []
+        if keep and arrived and (legal or not constrained):
+            rows.append(list(state.assign))
+
+        for _ in range(steps):
+            trans, curr_distr, flag, scored = step(
+                state, const, rng, propose, constrained, legal
+            )
+            if scored:
+                scores, alpha, beta = scored
+
+            if flag == "accept":
+                legal = scores["legal_prop"]
+                if keep and (legal or not constrained):
+                    rows.append(list(state.assign))
+
+            log.record(
+                i,
+                trans["node"],
+                curr_distr,
+                trans["prop_distr"],
+                scores,
+                trans["trans_in"],
+                trans["trans_out"],
+                alpha,
+                beta,
+                flag,
+            )
+            i += 1
+
+        conn.send((energy(state), rows))
+
+    log.flush()
+    conn.close()
+
+
+def energy(state):
+    """ Energy of the plan held by a PlanState, the exponent of its score
+    without the constant: population variance times the contiguity
+    sub-score """
+
+    _, pop_param, contig_param = score_state(state, 1)
+
+    return pop_param * contig_param
+
+
+def temper(
+    init_plan,
+    n,
+    consts,
+    fname,
+    every=100,
+    constrained=False,
+    rng=None,
+    proposal="flip",
+    log_chunk=500000,
+):
+    """ Runs parallel tempering over a ladder of score constants consts, one
+    replica process per constant, for n iterations in rounds of every. Plans
+    are kept at consts[0]. Returns a PlanStore of the plans visited there and
+    the swap acceptance rate for each neighbouring pair of constants """
+
+    if proposal not in PROPOSALS:
+        raise ValueError("Unknown proposal: {}".format(proposal))
+
+    # Consts[0] is the target, with the rest ordered away from it. Smaller
+    # constants flatten the score so their replicas move more freely. Each
+    # replica logs to fname-replica<j>-<k>.parquet (see log.read_log()) and
+    # draws from its own stream spawned from rng, with one more for swaps
+    k = len(consts)
+    if rng is None:
+        rng = ChainRNG()
+    rngs = rng.spawn(k + 1)
+    swap_rng = rngs[k]
+
+    # Compile the graph once and hand it to every replica
+    compiled = CompiledGraph(init_plan)
+
+    # Start a worker process for each replica
+    conns = []
+    procs = []
+    for j in range(k):
+        conn, child = Pipe()
+        proc = Process(
+            target=replica,
+            args=(
+                child,
+                init_plan,
+                "{}-replica{}".format(fname, j + 1),
+                constrained,
+                proposal,
+                rngs[j],
+                log_chunk,
+                compiled,
+            ),
+        )
+        proc.start()
+        conns.append(conn)
+        procs.append(proc)
+
+    # Rung of the ladder each replica is on. Replicas stay put and swap
+    # constants rather than plans
+    rung = list(range(k))
+    arrived = [True] * k
+    tries = [0] * (k - 1)
+    swaps = [0] * (k - 1)
+
+    plans = PlanStore(init_plan, compiled=compiled)
+    start = timeit.default_timer()
+    done = 0
+    r = 0
+
+    while done < n:
+        steps = min(every, n - done)
+
+        # Run a round on every replica at once and collect the results
+        for j in range(k):
+            conns[j].send((consts[rung[j]], steps, rung[j] == 0, arrived[j]))
+        results = [conn.recv() for conn in conns]
+        for row in results[rung.index(0)][1]:
+            plans.append(row)
+        done += steps
+
+        # Propose swaps between neighbouring rungs, alternating between even
+        # and odd pairs from round to round. Swapping the constants c1 and c2
+        # of replicas with energies E1 and E2 is accepted with probability
+        # min(1, e^((c1 - c2) * (E1 - E2))), which keeps each replica's chain
+        # targeting its own constant
+        arrived = [False] * k
+        for pos in range(r % 2, k - 1, 2):
+            a = rung.index(pos)
+            b = rung.index(pos + 1)
+            tries[pos] += 1
+
+            log_ratio = (consts[pos] - consts[pos + 1]) * (
+                results[a][0] - results[b][0]
+            )
+            if log_ratio >= 0 or swap_rng.uniform() < exp(log_ratio):
+                rung[a], rung[b] = rung[b], rung[a]
+                arrived[a] = arrived[b] = True
+                swaps[pos] += 1
+
+        r += 1
+
+        # Print progress and swap rates every 100 rounds
+        if r % 100 == 0 or done == n:
+            stop = timeit.default_timer()
+            line = "{} | Runtime:{:010.2f} | iter:{:.>10} | swaps:{}".format(
+                ctime(),
+                (stop - start),
+                done,
+                " ".join("{:.3f}".format(rate) for rate in swap_rates(tries, swaps)),
+            )
+            print(line)
+            with open("{}.txt".format(fname), "a+") as f:
+                print(line, file=f)
+
+    for conn in conns:
+        conn.send(None)
+    for proc in procs:
+        proc.join()
+
+    return plans, swap_rates(tries, swaps)
+
+
+def swap_rates(tries, swaps):
+    """ Returns the fraction of proposed swaps accepted for each neighbouring
+    pair of rungs """
+
+    return [s / t if t else 0 for t, s in zip(tries, swaps)]
@@ -1,7 +1,12 @@
 #!/usr/bin/env python
 """ Utility and helpful functions used across the application """
 
+from collections import defaultdict
 from collections import deque
+from math import ceil
+from math import floor
+
+import numpy as np
 
 
 def distr_nodes(distr, graph):
@@ -28,6 +33,65 @@ def distr_count(graph):
     return count
 
 
+class DistrStats:
+    """ Summary of a single district of a plan: its population, votes for
+    each party, and its nodes """
+
+    def __init__(self):
+        self.pop = 0
+        self.vote_circ = 0
+        self.vote_sqre = 0
+        self.nodes = []
+
+    @property
+    def count(self):
+        """ Number of nodes in the district """
+
+        return len(self.nodes)
+
+
+def distr_stats(graph):
+    """ Aggregates every district of a supplied graph in a single pass over its
+    nodes, rather than a scan of the graph per district as distr_nodes() and
+    distr_pop() make. Returns a dict of DistrStats keyed by district, with as
+    many entries as distr_count() gives. Looking up a district that has no
+    nodes gives an empty DistrStats """
+
+    stats = defaultdict(DistrStats)
+    for node, attrs in graph.nodes(data=True):
+        distr = stats[attrs["distr"]]
+        distr.pop += attrs["pop"]
+        distr.vote_circ += attrs["vote_circ"]
+        distr.vote_sqre += attrs["vote_sqre"]
+        distr.nodes.append(node)
+
+    return stats
+
+
+def set_pop_bounds(graph, tol=0.05):
+    """ Computes the population bounds for a district of a supplied graph as
+    the average district population +/- the supplied tolerance, rounded
+    outwards to whole residents, and caches them in the graph's attributes.
+    Returns the (lower, upper) bounds """
+
+    ideal = sum(pop for _, pop in graph.nodes.data("pop")) / distr_count(graph)
+    bounds = (floor(ideal * (1 - tol)), ceil(ideal * (1 + tol)))
+    graph.graph["pop_bounds"] = bounds
+
+    return bounds
+
+
+def pop_bounds(graph):
+    """ Returns the (lower, upper) district population bounds cached in a
+    supplied graph, computing them with the default tolerance if the graph
+    doesn't have any yet """
+
+    if "pop_bounds" not in graph.graph:
+        return set_pop_bounds(graph)
+
+    return tuple(graph.graph["pop_bounds"])
+
+
 def distr_pop(distr, graph):
     """ Tabulates the number of residents in a supplied district of a supplied
     graph """
@@ -40,12 +104,13 @@ def distr_pop(distr, graph):
     return total_pop
 
 
-def contig_distr(distr, graph):
+def contig_distr(distr, graph, nodes=None):
     """ Deploys breadth-first search algorithm to determine if supplied
-    district is contiguous. Returns boolean result """
+    district is contiguous. The district's nodes may be passed in, e.g. from
+    distr_stats(), to save finding them again. Returns boolean result """
 
     # Produce list of nodes in the district in question
-    d_nodes = distr_nodes(distr, graph)
+    d_nodes = distr_nodes(distr, graph) if nodes is None else nodes
 
     # A proposal plan which eliminates a district will get rejected 100% of the
     # time due to transition probabilities, but this function is called before
@@ -58,7 +123,7 @@ def contig_distr(distr, graph):
         init_node = d_nodes[0]
 
         # Send required arguments to breadth-first search (BFS) algorithm to
-        # get a list of contiguous nodes in the district
+        # get the set of contiguous nodes in the district
         contig_nodes = bfs(init_node, graph)
 
         # While the code above initialises with the first node in the district,
@@ -76,56 +141,138 @@ def bfs(node, graph):
     which share the district assignment of the supplied node. This is used to
     determine if the district is contiguous. """
 
-    # BFS is implemented using a queue and visited pair of lists. The queue
-    # tracks nodes that need to be explored. Once explored, they are removed
-    # from the queue and appended to the visited list. A while loop keeps the
-    # search going until the queue is empty.
+    # BFS is implemented using a queue and a visited set. The queue tracks
+    # nodes that need to be explored. Once explored, they are removed from the
+    # queue and added to the visited set, which keeps membership checks O(1).
+    # A while loop keeps the search going until the queue is empty.
     queue = deque([node])
-    visited = [node]
+    visited = {node}
 
     # Get district of supplied node
     distr = graph.nodes[node]["distr"]
 
     while queue:
         curr_node = queue.popleft()
-        nbors = list(graph.neighbors(curr_node))
-        d_nbors = [item for item in nbors if graph.nodes[item]["distr"] == distr]
-        for n in d_nbors:
-            if n not in visited:
+        for n in graph.neighbors(curr_node):
+            if n not in visited and graph.nodes[n]["distr"] == distr:
                 queue.append(n)
-                visited.append(n)
+                visited.add(n)
 
     return visited
 
 
-def graph_sig(graph):
-    """ Function which takes in a districting graph and returns a numerical
-    signature of that graph. This signature represents the node-to-district
-    mapping of all nodes in the graph """
+def cut_edges(graph):
+    """ Returns a list of the edges of a supplied graph whose end nodes lie in
+    different districts. This scans every edge, so when a PlanState is to
+    hand its cut_pairs() should be used instead """
+
+    return [
+        (a, b)
+        for a, b in graph.edges
+        if graph.nodes[a]["distr"] != graph.nodes[b]["distr"]
+    ]
+
 
-    # Start with signature as a string for easy concatenation
-    sig = ""
+def materialise(graph, nodes, assign):
+    """ Produces a copy of the supplied graph with the district assignments in
+    assign written to its nodes. Assign is ordered to match the nodes list """
 
-    for n in list(graph.nodes):
-        sig += str(n)
-        sig += str(graph.nodes[n]["distr"])
+    plan = graph.copy()
+    for node, distr in zip(nodes, assign):
+        plan.nodes[node]["distr"] = int(distr)
 
-    return int(sig)
+    return plan
 
 
-def remove_dups(graph_list):
+def subset(plans, indices):
+    """ Returns the plans at the supplied indices. Plans held in a PlanStore
+    stay packed rather than being materialised as graphs """
+
+    if hasattr(plans, "take"):
+        return plans.take(indices)
+
+    return [plans[i] for i in indices]
+
+
+def plan_sig(assign):
+    """ Function which takes in a sequence of district assignments, ordered by
+    node, and returns a fixed-width signature of it. Each assignment is packed
+    into a single byte, so two plans share a signature only if every node has
+    the same district """
+
+    return bytes(bytearray(assign))
+
+
+def graph_sig(graph):
+    """ Function which takes in a districting graph and returns a signature
+    of that graph. This signature represents the node-to-district mapping of
+    all nodes in the graph, taken in sorted node order """
+
+    return plan_sig(graph.nodes[n]["distr"] for n in sorted(graph.nodes))
+
+
+def remove_dups(graph_list, seen=None):
     """ Accepts a list of districting graphs and returns a new list without
     duplicates, where a duplicate is graph with the same district assignments
-    for every node"""
+    for every node. A PlanStore may be passed in place of the list, in which
+    case a PlanStore is returned with the weight of each duplicate added to
+    the copy kept. Passing a set of signatures as seen, e.g. from
+    load_sigs(), also drops plans seen in other runs and adds the new
+    signatures to it """
+
+    if seen is None:
+        seen = set()
+
+    # Plans held in a PlanStore are already packed, so their signatures can be
+    # read straight off the rows without building graphs
+    if hasattr(graph_list, "matrix"):
+        sigs = (row.tobytes() for row in graph_list.matrix())
+    else:
+        sigs = (graph_sig(graph) for graph in graph_list)
+
+    # Position of each kept plan in the output, so that the weights of its
+    # duplicates can be added to it
+    uniq = []
+    kept = {}
+    dups = []
+    for idx, sig in enumerate(sigs):
+        if sig not in seen:
+            seen.add(sig)
+            kept[sig] = len(uniq)
+            uniq.append(idx)
+        elif sig in kept:
+            dups.append((kept[sig], idx))
+
+    print("{} duplicate plans removed".format(len(graph_list) - len(uniq)))
+
+    # Plans in a store are weighted by the samples they stand for, so rather
+    # than being thrown away the weight of each duplicate goes to the copy
+    # that is kept. Plans already seen in other runs are dropped outright
+    plans = subset(graph_list, uniq)
+    if hasattr(graph_list, "plan_weights"):
+        weights = graph_list.plan_weights()
+        for pos, idx in dups:
+            plans.weights[pos] += weights[idx]
+
+    return plans
+
+
+def save_sigs(seen, fname):
+    """ Writes a set of plan signatures to an on-disk index so that later runs
+    can be deduplicated against it. Signatures are fixed-width so the index is
+    stored as a uint8 matrix with one row per plan """
+
+    sigs = b"".join(sorted(seen))
+    width = len(next(iter(seen))) if seen else 0
+    index = np.frombuffer(sigs, dtype=np.uint8).reshape(len(seen), width)
+
+    np.save(fname, index)
+
 
-    uniq_sigs = []
-    uniq_graphs = []
-    for graph in graph_list:
-        sig = graph_sig(graph)
-        if sig not in uniq_sigs:
-            uniq_sigs.append(sig)
-            uniq_graphs.append(graph)
+def load_sigs(fname):
+    """ Reads a signature index written by save_sigs() and returns it as a set
+    of signatures """
 
-    print("{} duplicate plans removed".format(len(graph_list) - len(uniq_graphs)))
+    index = np.load(fname)
 
-    return uniq_graphs
+    return {row.tobytes() for row in index}